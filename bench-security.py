@@ -0,0 +1,260 @@
+"""
+Benchmarkit main-security.py:lle, ajetaan juuresta:
+    python bench-security.py login
+
+login: /users/me/ -latenssi kun samaan aikaan hakataan /token-loginia, bcrypt suoraan event loopissa (HASH_WORKERS=0)
+vs omassa threadpoolissa.
+auth: get_current_user:n kesto per pyyntö samalla tokenilla, token-cache päällä vs pois (TOKEN_CACHE_SIZE=0).
+calibrate: verify-aika ja loginit/s/ydin eri hash-asetuksilla, ja suositus annetulle tavoitelatenssille.
+lookup: userin haun latenssi usernamella/emaililla kun users-taulussa on miljoona riviä.
+jwt: tokenin allekirjoitus ja verifiointi per sekunti joka algoritmilla (HS256/RS256/ES256), avainrenkaan
+parsitulla avaimella vs PEM:n parsinta joka kerta.
+Moodit ajetaan omissa prosesseissaan, koska asetukset luetaan importissa.
+"""
+
+import argparse
+import asyncio
+import atexit
+import importlib.util
+import itertools
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# main-security käyttää sql_appin kantaa, joka luetaan DB_URL:sta importissa -> oma väliaikainen kanta ennen sitä
+BENCH_DIR = tempfile.mkdtemp(prefix="security_bench_")
+atexit.register(shutil.rmtree, BENCH_DIR, ignore_errors=True)
+os.environ.setdefault("DB_URL", f"sqlite:///{os.path.join(BENCH_DIR, 'app.db')}")
+os.environ.setdefault("SLOW_QUERY_MS", "0")
+
+LOGIN = {"username": "pertti", "password": "secret"}
+
+
+def load_app():
+    # tiedostonimessä on viiva, joten tavallinen import ei käy
+    spec = importlib.util.spec_from_file_location("main_security", os.path.join(os.path.dirname(__file__), "main-security.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(samples: list[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[int(p * (len(ordered) - 1))] if ordered else 0.0
+
+
+async def measure_me(client, headers: dict, seconds: float, interval: float = 0.01) -> list[float]:
+    # tasatahtinen kysely, ja latenssi lasketaan siitä milloin pyyntö olisi pitänyt lähteä: jos event loop
+    # on blokattu, myös mittaaja jumittaa, ja lähetyshetkestä mitattuna odotus jäisi kokonaan näkymättä
+    latencies = []
+    start = time.perf_counter()
+    for i in itertools.count():
+        scheduled = start + i * interval
+        if time.perf_counter() > start + seconds:
+            break
+        await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+        (await client.get("/users/me/", headers=headers)).raise_for_status()
+        latencies.append((time.perf_counter() - scheduled) * 1000)
+    return latencies
+
+
+async def hammer_logins(client, stop: asyncio.Event, statuses: list[int]):
+    while not stop.is_set():
+        statuses.append((await client.post("/token", data=LOGIN)).status_code)
+
+
+async def run_login(args, security) -> None:
+    import httpx
+
+    transport = httpx.ASGITransport(app=security.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        token = (await client.post("/token", data=LOGIN)).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        idle = await measure_me(client, headers, args.seconds)
+
+        stop, statuses = asyncio.Event(), []
+        loggers = [asyncio.create_task(hammer_logins(client, stop, statuses)) for _ in range(args.logins)]
+        start = time.perf_counter()
+        busy = await measure_me(client, headers, args.seconds)
+        stop.set()
+        await asyncio.gather(*loggers)
+        elapsed = time.perf_counter() - start
+
+    ok = statuses.count(200)
+    print(f"{args.mode:>6} /users/me/ idle p50 {percentile(idle, 0.5):>7.1f} ms p99 {percentile(idle, 0.99):>7.1f} ms"
+          f" | with {args.logins} login loops p50 {percentile(busy, 0.5):>7.1f} ms p99 {percentile(busy, 0.99):>7.1f} ms"
+          f" | logins {ok / elapsed:.1f}/s, 503s {statuses.count(503)}")
+
+
+def bench_login(args):
+    if args.mode is None:
+        for mode in ("inline", "pool"):
+            env = dict(os.environ)
+            if mode == "inline":
+                env["HASH_WORKERS"] = "0"
+            cmd = [sys.executable, __file__, "login", "--mode", mode, "--logins", str(args.logins), "--seconds", str(args.seconds)]
+            subprocess.run(cmd, env=env, check=True)
+        return
+    asyncio.run(run_login(args, load_app()))
+
+
+def bench_auth(args):
+    if args.mode is None:
+        for mode in ("off", "on"):
+            env = dict(os.environ, TOKEN_CACHE_SIZE="0" if mode == "off" else "4096")
+            cmd = [sys.executable, __file__, "auth", "--mode", mode, "--calls", str(args.calls)]
+            subprocess.run(cmd, env=env, check=True)
+        return
+
+    from datetime import timedelta
+
+    security = load_app()
+    token = security.create_access_token({"sub": "pertti"}, expires_delta=timedelta(minutes=5))
+
+    async def run():
+        for _ in range(100):  # lämmitys
+            await security.get_current_user(token)
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            await security.get_current_user(token)
+        return (time.perf_counter() - start) / args.calls * 1e6
+
+    per_call = asyncio.run(run())
+    stats = security.token_cache.stats()
+    print(f"token cache {args.mode:>3}: {per_call:>7.1f} us per get_current_user"
+          f"  (hits {stats['hits']}, misses {stats['misses']}, evictions {stats['evictions']})")
+
+
+def bench_calibrate(args):
+    from passlib.hash import argon2
+
+    security = load_app()
+    settings = [(f"bcrypt rounds={rounds}", security.make_pwd_context("bcrypt", rounds=rounds)) for rounds in args.rounds]
+    if argon2.has_backend():
+        settings += [
+            (f"argon2 t={t} m={security.ARGON2_MEMORY_COST // 1024}MiB", security.make_pwd_context("argon2", time_cost=t))
+            for t in args.time_costs
+        ]
+    else:
+        print("argon2: no backend (pip install argon2-cffi), skipped")
+
+    print(f"{'setting':<24} {'verify ms':>10} {'logins/s/core':>14}")
+    for name, context in settings:
+        ms = security.verify_ms(context, samples=args.samples)
+        print(f"{name:<24} {ms:>10.1f} {1000 / ms:>14.1f}")
+
+    rounds = security.calibrate_bcrypt_rounds(args.target_ms)
+    print(f"\ntarget {args.target_ms:.0f} ms -> BCRYPT_ROUNDS={rounds}")
+    if argon2.has_backend():
+        print(f"target {args.target_ms:.0f} ms -> HASH_SCHEME=argon2 ARGON2_TIME_COST={security.calibrate_argon2_time_cost(args.target_ms)}")
+
+
+def bench_lookup(args):
+    from sqlalchemy import insert
+
+    from sql_app import models
+
+    security = load_app()
+    with security.SessionLocal() as db:
+        for start in range(0, args.users, 50_000):
+            rows = [
+                {"username": f"user{i}", "email": f"user{i}@bench.xyz", "full_name": f"User {i}",
+                 "hashed_password": "x", "is_active": True}
+                for i in range(start, min(start + 50_000, args.users))
+            ]
+            db.execute(insert(models.User), rows)
+        db.commit()
+
+        for name, statement in (("username", security.USER_BY_USERNAME), ("email", security.USER_BY_EMAIL)):
+            compiled = statement.compile(security.engine)
+            plan = db.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", ("x",)).all()
+            print(f"plan {name:<9} {' | '.join(row[-1] for row in plan)}")
+
+    for name, login in (("username", "user{}"), ("email", "user{}@bench.xyz")):
+        latencies = []
+        for _ in range(args.lookups):
+            key = login.format(random.randrange(args.users))
+            start = time.perf_counter()
+            assert security.load_user(key) is not None
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f"{args.users} users, by {name:<9} p50 {percentile(latencies, 0.5):.3f} ms  p99 {percentile(latencies, 0.99):.3f} ms"
+              f"  max {max(latencies):.3f} ms")
+
+
+def bench_jwt(args):
+    from datetime import timedelta
+
+    from cryptography.hazmat.primitives import serialization
+    from jose import jwt
+
+    security = load_app()
+
+    def rate(fn) -> float:
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            fn()
+        return args.calls / (time.perf_counter() - start)
+
+    claims = {"sub": "pertti"}
+    print(f"{'algorithm':<10} {'sign/s':>10} {'verify/s':>10} {'verify/s (PEM every time)':>26}")
+    for algorithm in args.algorithms:
+        ring = security.KeyRing()
+        if algorithm.startswith("HS"):
+            ring.add("bench", security.SECRET_KEY, algorithm)
+            pem = security.SECRET_KEY
+        else:
+            private = security.generate_private_key(algorithm)
+            ring.add("bench", private)
+            pem = private.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        security.key_ring = ring
+        token = security.create_access_token(claims, expires_delta=timedelta(minutes=5))
+        assert ring.verify(token)["sub"] == "pertti"
+        sign = rate(lambda: ring.sign(claims))
+        verify = rate(lambda: ring.verify(token))
+        reparse = rate(lambda: jwt.decode(token, pem, algorithms=[algorithm]))
+        print(f"{algorithm:<10} {sign:>10.0f} {verify:>10.0f} {reparse:>26.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python bench-security.py")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("login", help="/users/me/ latency while logins are hammered: inline bcrypt vs thread pool")
+    p.add_argument("--mode", choices=["inline", "pool"], default=None)
+    p.add_argument("--logins", type=int, default=8, help="concurrent login loops")
+    p.add_argument("--seconds", type=float, default=5)
+    p.set_defaults(fn=bench_login)
+
+    p = sub.add_parser("auth", help="per-request get_current_user cost with the decoded-token cache on/off")
+    p.add_argument("--mode", choices=["off", "on"], default=None)
+    p.add_argument("--calls", type=int, default=20000)
+    p.set_defaults(fn=bench_auth)
+
+    p = sub.add_parser("calibrate", help="verify latency and logins/s/core per hash setting, pick a cost for a target")
+    p.add_argument("--target-ms", type=float, default=100)
+    p.add_argument("--rounds", type=int, nargs="+", default=[8, 9, 10, 11, 12, 13])
+    p.add_argument("--time-costs", type=int, nargs="+", default=[1, 2, 3, 4])
+    p.add_argument("--samples", type=int, default=3)
+    p.set_defaults(fn=bench_calibrate)
+
+    p = sub.add_parser("lookup", help="user lookup latency by username/email on a big users table")
+    p.add_argument("--users", type=int, default=1_000_000)
+    p.add_argument("--lookups", type=int, default=5000)
+    p.set_defaults(fn=bench_lookup)
+
+    p = sub.add_parser("jwt", help="token sign/verify throughput per algorithm, parsed key vs PEM per call")
+    p.add_argument("--algorithms", nargs="+", default=["HS256", "RS256", "ES256"])
+    p.add_argument("--calls", type=int, default=2000)
+    p.set_defaults(fn=bench_jwt)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
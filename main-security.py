@@ -1,13 +1,28 @@
 # https://fastapi.tiangolo.com/tutorial/security/
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Annotated
 from datetime import datetime, timedelta
 
 from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
-from jose import JWTError, jwt
+from jose import JWTError, jwk, jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from passlib.context import CryptContext
 
+from sqlalchemy import bindparam, insert, select, update
+
+from sql_app import models
+from sql_app.crud import USER_VERSION
+from sql_app.cache import LRUCache
+from sql_app.database import SessionLocal, engine
+
 app = FastAPI()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -21,7 +36,6 @@ openssl rand -hex 32 --> tuolla komennolla voi generoida random stringin joka se
 """
 
 SECRET_KEY = "b5da31f5240b3030373f40b7a7fa63542fa727412558639039d34f2561857261"
-ALGORITH = "HS256"
 ACCESS_TOKEN_EXPIRES_MINUTES = 30
 
 fake_user_db = {
@@ -59,37 +73,354 @@ class User(BaseModel):
 
 class UserInDb(User):
     hashed_pwd: str
+    id: int | None = None
+    version: int | None = None  # users.version, token-cachen tarkistusta varten
+
+
+"""
+Hashin hinta: bcryptin rounds (jokainen +1 tuplaa ajan) tai argon2 (time/memory cost) rajaa suoraan montako
+loginia sekunnissa yksi ydin jaksaa. Asetukset envistä:
+ - HASH_SCHEME: "bcrypt" (oletus) tai "argon2" (vaatii argon2-cffi:n, ei requirementsissä)
+ - BCRYPT_ROUNDS / ARGON2_TIME_COST / ARGON2_MEMORY_COST (KiB)
+ - HASH_TARGET_MS: jos annettu, kustannus kalibroidaan käynnistyksessä tälle koneelle niin, että yksi verify
+   kestää korkeintaan tämän verran. Saman voi ajaa käsin: python bench-security.py calibrate --target-ms 100
+Kaikki muut kuin nykyiset asetukset on "deprecated", eli authenticate_user hashaa salasanan uudelleen
+onnistuneen loginin yhteydessä (verify_and_update), kun vanha hash on eri skeemalla tai eri kustannuksella.
+"""
+HASH_SCHEME = os.getenv("HASH_SCHEME", "bcrypt")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", str(64 * 1024)))
+HASH_TARGET_MS = float(os.getenv("HASH_TARGET_MS", "0"))
+
+
+def make_pwd_context(scheme: str = HASH_SCHEME, rounds: int = BCRYPT_ROUNDS, time_cost: int = ARGON2_TIME_COST,
+                     memory_cost: int = ARGON2_MEMORY_COST) -> CryptContext:
+    # min = max = default: myös kalliimmat vanhat hashit päivitetään, muuten login pysyisi hitaana
+    schemes = [scheme] + [other for other in ("bcrypt", "argon2") if other != scheme]
+    return CryptContext(
+        schemes=schemes,
+        deprecated="auto",
+        bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds,
+        argon2__time_cost=time_cost, argon2__memory_cost=memory_cost,
+    )
+
+
+def verify_ms(context: CryptContext, samples: int = 3) -> float:
+    # CPU-aika per verify (process_time), eli ms per ydin riippumatta muusta kuormasta
+    hashed = context.hash("calibration")
+    start = time.process_time()
+    for _ in range(samples):
+        context.verify("calibration", hashed)
+    return (time.process_time() - start) / samples * 1000
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def calibrate_bcrypt_rounds(target_ms: float) -> int:
+    # kalliimpi rounds tuplaa ajan, joten mitataan halvalla ja lasketaan suurin joka mahtuu tavoitteeseen
+    base = 8
+    per_round = verify_ms(make_pwd_context("bcrypt", rounds=base))
+    rounds = base
+    while rounds < 31 and per_round * 2 ** (rounds + 1 - base) <= target_ms:
+        rounds += 1
+    while rounds > 4 and per_round * 2 ** (rounds - base) > target_ms:
+        rounds -= 1
+    return rounds
+
+
+def calibrate_argon2_time_cost(target_ms: float, memory_cost: int = ARGON2_MEMORY_COST) -> int:
+    # time_cost skaalautuu about lineaarisesti
+    per_pass = verify_ms(make_pwd_context("argon2", time_cost=1, memory_cost=memory_cost))
+    return max(1, int(target_ms // per_pass))
+
+
+if HASH_TARGET_MS:
+    if HASH_SCHEME == "argon2":
+        ARGON2_TIME_COST = calibrate_argon2_time_cost(HASH_TARGET_MS)
+    else:
+        BCRYPT_ROUNDS = calibrate_bcrypt_rounds(HASH_TARGET_MS)
+
+pwd_context = make_pwd_context(HASH_SCHEME, BCRYPT_ROUNDS, ARGON2_TIME_COST, ARGON2_MEMORY_COST)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 app = FastAPI()
 
 
-def verify_password(plain_pwd, hashed_pwd):
-    return pwd_context.verify(plain_pwd, hashed_pwd)
+"""
+bcrypt vie ~250 ms CPU:ta per tarkistus. Suoraan async-reitissä se blokkaa koko event loopin, eli yksi login
+pysäyttää kaikki muut saman workerin pyynnöt. Siksi hash/verify ajetaan omassa threadpoolissa (bcrypt
+vapauttaa GIL:n, joten säikeet riittää). Koko ja jono envistä:
+ - HASH_WORKERS: säikeitä, oletuksena CPU-ytimien määrä (enempää ei kannata, työ on pelkkää CPU:ta).
+   0 = vanha tapa eli suoraan event loopissa (vertailua varten, ks. bench-security.py)
+ - HASH_QUEUE_LIMIT: montako saa odottaa vapaata säiettä, sen yli 503 + Retry-After eikä loputonta jonoa
+"""
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", "32"))
+
+
+class HashPool:
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.limit = workers + queue_limit
+        self.in_flight = 0  # käsitellään vain event loopissa, joten lukkoa ei tarvita
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pwd-hash") if workers else None
+
+    async def run(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins in progress",
+                headers={"Retry-After": "1"},
+            )
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.in_flight -= 1
+
+
+hash_pool = HashPool(HASH_WORKERS, HASH_QUEUE_LIMIT)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def verify_password(plain_pwd, hashed_pwd):
+    return await hash_pool.run(pwd_context.verify, plain_pwd, hashed_pwd)
+
+
+async def get_password_hash(password):
+    return await hash_pool.run(pwd_context.hash, password)
+
+
+"""
+Userit on sql_appin users-taulussa (sama kanta, DB_URL), ei fake_user_db:ssä: se toimii useammalla
+prosessilla ja miljoonilla usereilla. Haku on yksi unique-indeksin haku usernamella tai emaililla (jos
+loginissa on @), eli kesto ei riipu taulun koosta (mittaus: python bench-security.py lookup).
+fake_user_db on enää seed-data, joka lisätään kantaan käynnistyksessä jos sitä ei vielä ole.
+Kannan kutsut ajetaan threadpoolissa, koska reitit on async.
+"""
+USER_BY_USERNAME = select(models.User).where(models.User.username == bindparam("login"))
+USER_BY_EMAIL = select(models.User).where(models.User.email == bindparam("login"))
+
+
+def seed_users(db, users: dict):
+    existing = set(db.scalars(select(models.User.username).where(models.User.username.in_(list(users)))))
+    rows = [
+        {"username": u["username"], "email": u["email"], "full_name": u["full_name"],
+         "hashed_password": u["hashed_pwd"], "is_active": not u["disabled"]}
+        for username, u in users.items() if username not in existing
+    ]
+    if rows:
+        db.execute(insert(models.User), rows)
+        db.commit()
+
+
+models.Base.metadata.create_all(bind=engine)
+models.create_logins(engine)
+models.create_versions(engine)
+with SessionLocal() as db:
+    seed_users(db, fake_user_db)
 
 
 def get_user(db, username: str):
-    if username in db:
-        user_dict = db[username]
-        return UserInDb(**user_dict)
+    statement = USER_BY_EMAIL if "@" in username else USER_BY_USERNAME
+    db_user = db.scalars(statement, {"login": username}).first()
+    if db_user is None or db_user.username is None:
+        return None
+    return UserInDb(
+        username=db_user.username,
+        email=db_user.email,
+        full_name=db_user.full_name,
+        disabled=not db_user.is_active,
+        hashed_pwd=db_user.hashed_password,
+        id=db_user.id,
+        version=db_user.version,
+    )
+
+
+def load_user(username: str):
+    with SessionLocal() as db:
+        return get_user(db, username)
+
+
+def save_password_hash(username: str, hashed_pwd: str):
+    with SessionLocal() as db:
+        db.execute(update(models.User).where(models.User.username == username).values(hashed_password=hashed_pwd))
+        db.commit()
+
+
+def check_password(password: str, hashed_pwd: str):
+    try:
+        return pwd_context.verify_and_update(password, hashed_pwd)
+    except ValueError:
+        # sql_appin /users/-reitin kautta luoduilla ei ole oikeaa hashia
+        return False, None
 
 
-def authenticate_user(fake_db, username: str, password: str):
-    user = get_user(fake_db, username)
+async def authenticate_user(username: str, password: str):
+    user = await run_in_threadpool(load_user, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_pwd):
+    ok, new_hash = await hash_pool.run(check_password, password, user.hashed_pwd)
+    if not ok:
         return False
+    if new_hash:
+        # vanha skeema tai kustannus -> tallennetaan uusi hash nyt kun selväkielinen salasana on käsissä
+        await run_in_threadpool(save_password_hash, user.username, new_hash)
+        user.hashed_pwd = new_hash
+        invalidate_user(user.username)
     return user
 
 
+"""
+Tokenit allekirjoitetaan avainrenkaalla (KeyRing): jokaisella avaimella on kid, joka menee tokenin headeriin,
+ja verifioinnissa avain ja algoritmi valitaan kid:n perusteella (ei tokenin alg-kentästä). HS256 + SECRET_KEY
+vaatii saman salaisuuden jokaiselle nodelle joka tarkistaa tokeneita; asymmetrisillä avaimilla yksityinen
+avain on vain myöntäjällä ja muille riittää julkinen (/.well-known/jwks.json).
+ - JWT_ALGORITHM: HS256 (oletus), RS256 tai ES256. python-josessa ei ole EdDSA:ta, ES256 (P-256) on sen sijaan
+   nopea asymmetrinen vaihtoehto. Ilman JWT_KEYS_DIR:iä RS/ES-avain generoidaan käynnistyksessä (vain yksi prosessi)
+ - JWT_KEYS_DIR: hakemisto jossa <kid>.pem -tiedostot (RSA tai EC, yksityinen tai pelkkä julkinen avain).
+   Allekirjoitukseen käytetään yksityisistä avaimista aakkosjärjestyksessä viimeistä, eli kid:ksi vaikka päivämäärä
+ - JWT_KEYS_RELOAD_SECONDS: hakemiston uudelleenluvun väli (oletus 60)
+Rotaatio ilman katkoa: uuden avaimen julkinen osa jaetaan ensin kaikille (tuntematon kid lukee hakemiston heti
+uudelleen), sitten yksityinen myöntäjälle, jolloin uudet tokenit allekirjoitetaan sillä. Vanha tiedosto poistetaan
+vasta kun sillä allekirjoitetut tokenit on vanhentuneet (ACCESS_TOKEN_EXPIRES_MINUTES). HS256:sta siirrytään
+samoin: JWT_KEYS_DIR päälle, jolloin vanhat kid:ttömät HS-tokenit kelpaa yhä, ja myöhemmin JWT_ALGORITHM pois HS:stä.
+PEM parsitaan vain kun tiedosto on muuttunut (mtime), joten verifiointi on dict-haku + allekirjoituksen tarkistus.
+Mittaus: python bench-security.py jwt
+"""
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "")
+JWT_KEYS_RELOAD_SECONDS = float(os.getenv("JWT_KEYS_RELOAD_SECONDS", "60"))
+DEFAULT_KID = "default"  # SECRET_KEY / generoitu avain, ja kid:ttömät (vanhat) tokenit
+
+
+def generate_private_key(algorithm: str):
+    if algorithm == "RS256":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if algorithm == "ES256":
+        return ec.generate_private_key(ec.SECP256R1())
+    raise ValueError(f"Unsupported JWT algorithm {algorithm}")
+
+
+def key_algorithm(key) -> str:
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return "RS256"
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+        return {"secp256r1": "ES256", "secp384r1": "ES384", "secp521r1": "ES512"}[key.curve.name]
+    raise ValueError(f"Unsupported key type {type(key).__name__}")
+
+
+def load_pem(data: bytes):
+    if b"PRIVATE KEY" in data:
+        return serialization.load_pem_private_key(data, password=None)
+    return serialization.load_pem_public_key(data)
+
+
+class KeyRing:
+    def __init__(self, directory: str = "", reload_seconds: float = 60):
+        self.directory = directory
+        self.reload_seconds = reload_seconds
+        self.keys: dict[str, tuple] = {}  # kid -> (parsittu julkinen jose-avain, algoritmi), HS:llä salaisuus
+        self.signers: dict[str, object] = {}  # kid -> parsittu yksityinen jose-avain / HS-salaisuus
+        self.active_kid: str | None = None
+        self._files: dict[str, float] = {}  # kid -> tiedoston mtime viime latauksessa
+        self._loaded_at = 0.0
+        self._forced_at = 0.0
+
+    def add(self, kid: str, key, algorithm: str | None = None, activate: bool = True):
+        # key: cryptographyn avainobjekti, tai HS-algoritmilla salaisuus
+        algorithm = algorithm or key_algorithm(key)
+        private = hasattr(key, "private_bytes")
+        if private:
+            # python-jose ottaa julkiset avainobjektit sellaisenaan, mutta RSA:n yksityisen vain PEM:nä
+            key = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        parsed = jwk.construct(key, algorithm)
+        self.keys[kid] = (parsed.public_key() if private else parsed, algorithm)
+        self.signers.pop(kid, None)
+        if private or algorithm.startswith("HS"):
+            self.signers[kid] = parsed
+            if activate:
+                self.active_kid = kid
+
+    def remove(self, kid: str):
+        self.keys.pop(kid, None)
+        self.signers.pop(kid, None)
+        if self.active_kid == kid:
+            self.active_kid = max(self.signers, default=None)
+
+    def reload(self):
+        seen = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pem"):
+                continue
+            kid, path = name[:-4], os.path.join(self.directory, name)
+            seen[kid] = os.stat(path).st_mtime
+            if self._files.get(kid) != seen[kid]:
+                with open(path, "rb") as f:
+                    self.add(kid, load_pem(f.read()), activate=False)
+        for kid in self._files.keys() - seen.keys():
+            self.remove(kid)
+        self._files = seen
+        self.active_kid = max((kid for kid in seen if kid in self.signers), default=self.active_kid)
+        self._loaded_at = time.monotonic()
+
+    def maybe_reload(self, force: bool = False):
+        if not self.directory:
+            return
+        now = time.monotonic()
+        # tuntematon kid pakottaa latauksen, mutta korkeintaan kerran sekunnissa (roskatokeneilla ei saa hakkaamaan levyä)
+        if force and now - self._forced_at >= 1:
+            self._forced_at = now
+            self.reload()
+        elif now - self._loaded_at >= self.reload_seconds:
+            self.reload()
+
+    def sign(self, claims: dict) -> str:
+        self.maybe_reload()
+        if self.active_kid is None:
+            raise RuntimeError("No signing key in the JWT key ring")
+        algorithm = self.keys[self.active_kid][1]
+        return jwt.encode(claims, self.signers[self.active_kid], algorithm=algorithm, headers={"kid": self.active_kid})
+
+    def verify(self, token: str) -> dict:
+        self.maybe_reload()
+        kid = jwt.get_unverified_header(token).get("kid", DEFAULT_KID)
+        if not isinstance(kid, str):
+            raise JWTError("Invalid key id")
+        if kid not in self.keys:
+            self.maybe_reload(force=True)
+        if kid not in self.keys:
+            raise JWTError(f"Unknown key id {kid}")
+        key, algorithm = self.keys[kid]
+        return jwt.decode(token, key, algorithms=[algorithm])
+
+    def jwks(self) -> dict:
+        # HS-salaisuutta ei tietenkään julkaista
+        return {
+            "keys": [
+                {**key.public_key().to_dict(), "kid": kid, "use": "sig", "alg": algorithm}
+                for kid, (key, algorithm) in sorted(self.keys.items())
+                if not algorithm.startswith("HS")
+            ]
+        }
+
+
+def make_key_ring() -> KeyRing:
+    ring = KeyRing(JWT_KEYS_DIR, JWT_KEYS_RELOAD_SECONDS)
+    if JWT_ALGORITHM.startswith("HS"):
+        ring.add(DEFAULT_KID, SECRET_KEY, JWT_ALGORITHM)
+    elif not JWT_KEYS_DIR:
+        ring.add(DEFAULT_KID, generate_private_key(JWT_ALGORITHM))
+    if JWT_KEYS_DIR:
+        ring.reload()
+    return ring
+
+
+key_ring = make_key_ring()
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
 
@@ -100,14 +431,66 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
     to_encode.update({"exp": expire})
 
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITH)
+    encoded_jwt = key_ring.sign(to_encode)
     return encoded_jwt
 
 
+"""
+Dekoodattujen tokenien cache: sama bearer-token tulee yleensä tuhansia kertoja peräkkäin, joten key_ring.verify
+(allekirjoitus + JSON) ja userin haku tehdään vain kerran per token. Avain on tokenin sha256, ettei muistissa ole
+käyttökelpoisia tokeneita. Entry vanhenee tokenin exp:n kohdalla, ja invalidate_user pudottaa userin kaikki
+tokenit kerralla: jokaisessa entryssä on userin "sukupolvi", joka kasvaa invalidoinnissa, joten vanhat
+entryt ei enää kelpaa eikä tokeneita tarvitse etsiä userin perusteella.
+Userit on jaetussa kannassa, jota muut prosessit (tai käsin ajettu SQL) voi muuttaa, joten sukupolvi ei yksin
+riitä: jokainen osuma tarkistetaan users.versionista PK-haulla (triggeri kasvattaa sitä jokaisessa muutoksessa,
+ks. models.VERSION_DDL). Eri versio tai disabloitu user -> entry pois ja normaali polku.
+TOKEN_CACHE_SIZE=0 ottaa pois päältä. Laskurit: /metrics/token-cache
+"""
+token_cache = LRUCache(maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "4096")), ttl=ACCESS_TOKEN_EXPIRES_MINUTES * 60)
+user_generations: dict[str, int] = {}
+
+
+def token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def invalidate_user(username: str):
+    # kutsutaan aina kun userin tiedot muuttuu tai se disabloidaan
+    user_generations[username] = user_generations.get(username, 0) + 1
+
+
+def load_user_version(user_id: int) -> int | None:
+    # pelkkä yhteys ilman Sessionia, tämä on joka pyynnön polulla
+    with engine.connect() as conn:
+        return conn.scalar(USER_VERSION, {"user_id": user_id})
+
+
+async def cached_user(token: str):
+    key = token_key(token)
+    entry = token_cache.get(key)
+    if entry is None:
+        return None
+    user, generation = entry
+    if (user.disabled or user_generations.get(user.username, 0) != generation
+            or await run_in_threadpool(load_user_version, user.id) != user.version):
+        token_cache.delete(key)
+        return None
+    return user
+
+
+def cache_user(token: str, user: UserInDb, exp: int | None):
+    ttl = exp - time.time() if exp else 0
+    if ttl > 0 and not user.disabled:
+        token_cache.set(token_key(token), (user, user_generations.get(user.username, 0)), ttl=ttl)
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+    user = await cached_user(token)
+    if user is not None:
+        return user
 
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITH])
+        payload = key_ring.verify(token)
         username: str = payload.get("sub")
 
         if username is None:
@@ -117,10 +500,11 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     except JWTError:
         raise credentials_exception
 
-    user = get_user(fake_user_db, username=token_data.username)
+    user = await run_in_threadpool(load_user, token_data.username)
     if user is None:
         raise credentials_exception
 
+    cache_user(token, user, payload.get("exp"))
     return user
 
 
@@ -134,9 +518,7 @@ async def get_current_active_user(
 
 @app.post("/token", response_model=Token)
 async def login_for_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    user = authenticate_user(
-        fake_user_db, form_data.username, form_data.password
-    )
+    user = await authenticate_user(form_data.username, form_data.password)
 
     if not user:
         raise credentials_exception
@@ -155,6 +537,16 @@ async def read_users_me(
 ):
     return current_user
 
+
+@app.get("/metrics/token-cache")
+async def read_token_cache_metrics():
+    return token_cache.stats()
+
+
+@app.get("/.well-known/jwks.json")
+async def read_jwks():
+    return key_ring.jwks()
+
 """ Aikaisemmat chapterit alla, missä feikki-autentikoinnit jne """
 
 
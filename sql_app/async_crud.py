@@ -0,0 +1,135 @@
+from sqlalchemy import bindparam, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from . import crud, models, schemas
+from .crud import (COUNTER_VALUE, ITEM_VERSIONS_PAGE, ITEMS_PAGE, OWNER_ITEM_VERSIONS_PAGE, OWNER_ITEMS_PAGE, SEARCH_ITEMS,
+                   USER_EXISTS, USER_VERSION, USER_VERSIONS_PAGE, USERS_PAGE, _page_params, _pick, fts_query,
+                   invalidate_user, user_cache)
+
+"""
+Samat kuin crud.py:ssä, mutta AsyncSessionille. Asyncissa lazy load ei toimi ollenkaan
+(ei voi awaitata attribuutin lukua), joten items ladataan aina selectinloadilla.
+Listojen valmiit statementit jaetaan crud.py:n kanssa.
+"""
+
+USER_BY_ID = select(models.User).options(selectinload(models.User.items)).where(models.User.id == bindparam("user_id"))
+USER_BY_EMAIL = select(models.User).where(models.User.email == bindparam("email"))
+
+
+async def get_user_with_version(db: AsyncSession, user_id: int) -> tuple[schemas.User, int] | None:
+    # sama cache kuin crud.get_user_with_versionilla
+    key = f"user:{user_id}"
+    entry = user_cache.get(key)
+    if entry is None:
+        db_user = await db.scalar(USER_BY_ID, {"user_id": user_id})
+        if db_user is None:
+            return None
+        entry = (schemas.User.from_orm(db_user), db_user.version)
+        user_cache.set(key, entry)
+    return entry
+
+
+async def get_user(db: AsyncSession, user_id: int):
+    entry = await get_user_with_version(db, user_id=user_id)
+    return None if entry is None else entry[0]
+
+
+async def get_user_version(db: AsyncSession, user_id: int) -> int | None:
+    entry = user_cache.get(f"user:{user_id}")
+    if entry is not None:
+        return entry[1]
+    return await db.scalar(USER_VERSION, {"user_id": user_id})
+
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    return await db.scalar(USER_BY_EMAIL, {"email": email})
+
+
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    return (await db.scalars(_pick(USERS_PAGE, after_id), _page_params(skip, limit, after_id))).all()
+
+
+async def create_user(db: AsyncSession, user: schemas.UserRequest):
+    # ks. crud.create_user
+    fake_hash = user.password + "not-really-a-hash"
+    statement = (
+        insert(models.User)
+        .values(email=user.email, hashed_password=fake_hash, is_active=True)
+        .returning(models.User.id, models.User.is_active)
+    )
+    try:
+        row = (await db.execute(statement)).one()
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        return None
+    return schemas.User(id=row.id, email=user.email, is_active=row.is_active, items=[])
+
+
+async def create_users(db: AsyncSession, users: list[schemas.UserRequest]) -> list[schemas.BulkResult]:
+    # savepoint-fallbackeineen sama logiikka kuin crud.create_usersissa, joten ajetaan se sync-sessiona (run_sync)
+    return await db.run_sync(crud.create_users, users)
+
+
+async def user_exists(db: AsyncSession, user_id: int) -> bool:
+    return await db.scalar(USER_EXISTS, {"user_id": user_id}) is not None
+
+
+async def get_items(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int | None = None, owner_id: int | None = None):
+    params = _page_params(skip, limit, after_id)
+    if owner_id is None:
+        return (await db.scalars(_pick(ITEMS_PAGE, after_id), params)).all()
+    params["owner_id"] = owner_id
+    return (await db.scalars(_pick(OWNER_ITEMS_PAGE, after_id), params)).all()
+
+
+async def get_user_versions(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int | None = None) -> list[tuple[int, int]]:
+    return (await db.execute(_pick(USER_VERSIONS_PAGE, after_id), _page_params(skip, limit, after_id))).all()
+
+
+async def get_item_versions(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int | None = None, owner_id: int | None = None) -> list[tuple[int, int]]:
+    params = _page_params(skip, limit, after_id)
+    if owner_id is None:
+        return (await db.execute(_pick(ITEM_VERSIONS_PAGE, after_id), params)).all()
+    params["owner_id"] = owner_id
+    return (await db.execute(_pick(OWNER_ITEM_VERSIONS_PAGE, after_id), params)).all()
+
+
+async def get_count(db: AsyncSession, name: str) -> int:
+    # ks. crud.get_count
+    return await db.scalar(COUNTER_VALUE, {"name": name}) or 0
+
+
+async def create_item(db: AsyncSession, item: schemas.ItemRequest, user_id: int):
+    db_item = models.Item(**item.dict(), owner_id=user_id)
+    db.add(db_item)
+    await db.commit()
+    invalidate_user(user_id)
+    return db_item
+
+
+async def create_items(db: AsyncSession, items: list[schemas.ItemRequest], user_id: int) -> list[schemas.BulkResult]:
+    return await db.run_sync(crud.create_items, items, user_id)
+
+
+async def search_items(db: AsyncSession, q: str, skip: int = 0, limit: int = 20):
+    query = fts_query(q)
+    if not query:
+        return []
+    statement = select(models.Item).from_statement(SEARCH_ITEMS)
+    return (await db.scalars(statement, {"query": query, "limit": limit, "skip": skip})).all()
+
+
+async def stream_users(db: AsyncSession, chunk: int = 1000):
+    # ks. crud.stream_users: stream_scalars + yield_per hakee chunk kerrallaan
+    query = select(models.User).options(selectinload(models.User.items)).order_by(models.User.id).execution_options(yield_per=chunk)
+    async for db_user in await db.stream_scalars(query):
+        yield schemas.User.from_orm(db_user)
+
+
+async def stream_items(db: AsyncSession, chunk: int = 1000):
+    query = select(models.Item).order_by(models.Item.id).execution_options(yield_per=chunk)
+    async for db_item in await db.stream_scalars(query):
+        yield schemas.Item.from_orm(db_item)
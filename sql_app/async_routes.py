@@ -0,0 +1,109 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import async_crud, crud, schemas
+from .database import AsyncSessionLocal
+from .dependencies import get_after_id, get_async_db
+from .etags import etag_matches, list_etag, not_modified, user_etag
+
+"""
+Samat reitit kuin main.py:ssä, mutta async def + AsyncSession. Käyttöön DB_ASYNC=1:llä.
+"""
+
+router = APIRouter()
+
+
+def page_headers(rows: list, limit: int, total: int) -> dict:
+    headers = {"X-Total-Count": str(total)}
+    cursor = crud.next_cursor(rows, limit)
+    if cursor:
+        headers["X-Next-Cursor"] = cursor
+    return headers
+
+
+async def ndjson(stream):
+    # oma sessio generaattorille, kuten main.ndjson
+    async with AsyncSessionLocal() as db:
+        async for row in stream(db):
+            yield row.json() + "\n"
+
+
+@router.post("/users/", response_model=schemas.User)
+async def create_user(user: schemas.UserRequest, db: AsyncSession = Depends(get_async_db)):
+    db_user = await async_crud.create_user(db=db, user=user)
+    if db_user is None:
+        raise HTTPException(status_code=400, detail="Email already in use")
+    return db_user
+
+
+@router.post("/users/bulk", response_model=list[schemas.BulkResult])
+async def create_users(users: list[schemas.UserRequest], db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.create_users(db=db, users=users)
+
+
+@router.get("/users/", response_model=list[schemas.User])
+async def read_users(response: Response, skip: int = 0, limit: int = 100, after_id: int | None = Depends(get_after_id), if_none_match: str | None = Header(default=None), db: AsyncSession = Depends(get_async_db)):
+    total = await async_crud.get_count(db, crud.USERS_COUNTER)
+    etag = list_etag("users", await async_crud.get_user_versions(db, skip=skip, limit=limit, after_id=after_id), total)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    users = await async_crud.get_users(db, skip=skip, limit=limit, after_id=after_id)
+    response.headers.update(page_headers(users, limit, total))
+    response.headers["ETag"] = etag
+    return users
+
+
+# ennen /users/{user_id}:tä, muuten "export" yritetään parsia id:ksi
+@router.get("/users/export")
+async def export_users():
+    return StreamingResponse(ndjson(async_crud.stream_users), media_type="application/x-ndjson")
+
+
+@router.get("/users/{user_id}", response_model=schemas.User)
+async def read_user(user_id: int, response: Response, if_none_match: str | None = Header(default=None), db: AsyncSession = Depends(get_async_db)):
+    if if_none_match:
+        version = await async_crud.get_user_version(db, user_id=user_id)
+        if version is not None and etag_matches(if_none_match, user_etag(user_id, version)):
+            return not_modified(user_etag(user_id, version))
+    entry = await async_crud.get_user_with_version(db, user_id=user_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    db_user, version = entry
+    response.headers["ETag"] = user_etag(user_id, version)
+    return db_user
+
+
+@router.post("/users/{user_id}/items", response_model=schemas.Item)
+async def create_item(user_id: int, item: schemas.ItemRequest, db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.create_item(db=db, item=item, user_id=user_id)
+
+
+@router.post("/users/{user_id}/items/bulk", response_model=list[schemas.BulkResult])
+async def create_items(user_id: int, items: list[schemas.ItemRequest], db: AsyncSession = Depends(get_async_db)):
+    if not await async_crud.user_exists(db, user_id=user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    return await async_crud.create_items(db=db, items=items, user_id=user_id)
+
+
+@router.get("/items/", response_model=list[schemas.Item])
+async def read_items(response: Response, skip: int = 0, limit: int = 100, owner_id: int | None = None, after_id: int | None = Depends(get_after_id), if_none_match: str | None = Header(default=None), db: AsyncSession = Depends(get_async_db)):
+    total = await async_crud.get_count(db, crud.items_counter(owner_id))
+    versions = await async_crud.get_item_versions(db, skip=skip, limit=limit, after_id=after_id, owner_id=owner_id)
+    etag = list_etag("items", versions, total)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    items = await async_crud.get_items(db, skip=skip, limit=limit, after_id=after_id, owner_id=owner_id)
+    response.headers.update(page_headers(items, limit, total))
+    response.headers["ETag"] = etag
+    return items
+
+
+@router.get("/items/search", response_model=list[schemas.Item])
+async def search_items(q: str = Query(min_length=1), skip: int = 0, limit: int = Query(default=20, le=100), db: AsyncSession = Depends(get_async_db)):
+    return await async_crud.search_items(db, q=q, skip=skip, limit=limit)
+
+
+@router.get("/items/export")
+async def export_items():
+    return StreamingResponse(ndjson(async_crud.stream_items), media_type="application/x-ndjson")
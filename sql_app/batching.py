@@ -0,0 +1,100 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from . import crud, schemas
+
+"""
+Group commit itemien luontiin (ITEM_WRITE_BATCH=1). SQLitessä jokainen commit on oma fsync ja
+kirjoituslukko, joten yhtäaikaiset POST /users/{id}/items -pyynnöt kerätään jonoon ja yksi
+taustasäie kirjoittaa ne yhdessä transaktiossa:
+ - erä lähtee kun ensimmäisestä rivistä on kulunut ITEM_WRITE_WINDOW_MS tai rivejä on ITEM_WRITE_MAX_BATCH
+ - jokainen kutsuja saa oman schemas.Itemin id:n kera, kuten crud.create_itemistä
+Hinta on enintään ikkunan verran lisälatenssia per pyyntö.
+Kutsuja odottaa korkeintaan ITEM_WRITE_TIMEOUT sekuntia (TimeoutError). Jos erää ei ole vielä aloitettu,
+rivi jätetään kirjoittamatta; jos se on jo kirjoituksessa, odotetaan vielä toinen timeout.
+Säie ei kuole virheisiin: odottavat kutsujat saa poikkeuksen ja seuraava erä jatkaa normaalisti.
+"""
+
+ITEM_WRITE_BATCH = os.getenv("ITEM_WRITE_BATCH", "0") == "1"
+ITEM_WRITE_WINDOW_MS = float(os.getenv("ITEM_WRITE_WINDOW_MS", "5"))
+ITEM_WRITE_MAX_BATCH = int(os.getenv("ITEM_WRITE_MAX_BATCH", "100"))
+ITEM_WRITE_TIMEOUT = float(os.getenv("ITEM_WRITE_TIMEOUT", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class ItemWriteCoalescer:
+    def __init__(self, session_factory, window_ms: float = ITEM_WRITE_WINDOW_MS, max_batch: int = ITEM_WRITE_MAX_BATCH,
+                 timeout: float = ITEM_WRITE_TIMEOUT):
+        self.session_factory = session_factory
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._queue: queue.Queue[tuple[dict, Future]] = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, item: schemas.ItemRequest, user_id: int) -> schemas.Item:
+        self._ensure_started()
+        future = Future()
+        self._queue.put(({**item.dict(), "owner_id": user_id}, future))
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            if future.cancel():
+                raise
+            return future.result(timeout=self.timeout)
+
+    def _ensure_started(self):
+        # säie käynnistetään vasta ensimmäisestä kirjoituksesta, ei importissa (ja uudelleen, jos se on kuollut)
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="item-write-coalescer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # esim. session_factory tai rollback itse kaatui
+                logger.exception("item write batch failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _flush(self, batch: list[tuple[dict, Future]]):
+        # timeoutin jälkeen peruttuja ei kirjoiteta, ja tästä eteenpäin perua ei voi
+        batch = [(row, future) for row, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        rows = [row for row, _ in batch]
+        with self.session_factory() as db:
+            try:
+                ids = crud.insert_items(db, rows)
+            except Exception:
+                db.rollback()
+                # yksi huono rivi ei saa kaataa muiden kirjoituksia -> rivi kerrallaan
+                for row, future in batch:
+                    try:
+                        future.set_result(schemas.Item(id=crud.insert_items(db, [row])[0], **row))
+                    except Exception as e:
+                        db.rollback()
+                        future.set_exception(e)
+                return
+        for (row, future), item_id in zip(batch, ids):
+            future.set_result(schemas.Item(id=item_id, **row))
@@ -0,0 +1,760 @@
+"""
+Benchmarkit sql_app:lle, ajetaan juuresta esim:
+    python -m sql_app.bench pagination --rows 1000000
+
+Jokainen benchmark luo oman väliaikaisen SQLite-kannan, eli ./sql_app.db ei muutu.
+"""
+
+import argparse
+import asyncio
+import atexit
+import importlib
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+# database lukee DB_URL:n importissa, joten oma kanta pitää asettaa ennen sql_app-importteja
+BENCH_DIR = tempfile.mkdtemp(prefix="sql_app_bench_")
+atexit.register(shutil.rmtree, BENCH_DIR, ignore_errors=True)
+os.environ["DB_URL"] = f"sqlite:///{os.path.join(BENCH_DIR, 'app.db')}"
+os.environ.setdefault("SLOW_QUERY_MS", "0")  # seedauksen isot insertit täyttäisi lokin
+
+from sqlalchemy import create_engine, event, insert, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from . import crud, models  # noqa: E402
+
+
+def make_session(path: str, search_index: bool = True):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    models.Base.metadata.create_all(bind=engine)
+    if search_index:
+        models.create_search_index(engine)
+    models.create_counters(engine)
+    models.create_versions(engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def seed(db, users: int, items_per_user: int = 0, chunk: int = 50_000):
+    for start in range(0, users, chunk):
+        rows = [
+            {"email": f"user{i}@bench.xyz", "hashed_password": "x", "is_active": True}
+            for i in range(start, min(start + chunk, users))
+        ]
+        db.execute(insert(models.User), rows)
+    if items_per_user:
+        for start in range(0, users, chunk):
+            rows = [
+                {"title": f"item {u}-{n}", "description": f"description of item {n} owned by {u}", "owner_id": u + 1}
+                for u in range(start, min(start + chunk, users))
+                for n in range(items_per_user)
+            ]
+            db.execute(insert(models.Item), rows)
+    db.commit()
+
+
+def load_app():
+    # appi käyttää BENCH_DIR/app.db:tä, ks. modulin alku
+    return importlib.import_module("sql_app.main")
+
+
+@contextmanager
+def count_queries(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def timed(fn, repeat: int) -> float:
+    # palauttaa mediaanin millisekunteina
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def bench_pagination(args):
+    SessionLocal = make_session(os.path.join(BENCH_DIR, "pagination.db"))
+    with SessionLocal() as db:
+        seed(db, args.rows)
+        print(f"{'depth':>10} {'offset ms':>10} {'cursor ms':>10}")
+        depth = args.limit
+        while depth < args.rows:
+            offset_ms = timed(lambda: crud.get_users(db, skip=depth, limit=args.limit), args.repeat)
+            after_id = crud.decode_cursor(crud.encode_cursor(depth))
+            cursor_ms = timed(lambda: crud.get_users(db, limit=args.limit, after_id=after_id), args.repeat)
+            print(f"{depth:>10} {offset_ms:>10.2f} {cursor_ms:>10.2f}")
+            depth *= 10
+
+
+def check_queries(args):
+    """
+    Varmistaa, ettei N+1 palaa: kyselyjen määrä per pyyntö ei saa riippua sivun koosta.
+    Exit code 1 jos jokin ylittää rajan, eli käy CI-tarkistukseksi.
+    """
+    from fastapi.testclient import TestClient
+
+    main = load_app()
+    with main.SessionLocal() as db:
+        seed(db, args.users, items_per_user=3)
+    client = TestClient(main.app)
+
+    # listoissa +1 kysely X-Total-Countin laskurille (PK-haku counters-tauluun) ja +1 ETagin (id, versio) -sivulle
+    expected = [
+        ("/users/?limit=1", 4),
+        (f"/users/?limit={args.users}", 4),
+        ("/users/1", 1),
+        (f"/items/?limit={args.users}", 3),
+        ("/items/?owner_id=1", 3),
+    ]
+    failed = False
+    for url, limit in expected:
+        with count_queries(main.engine) as statements:
+            client.get(url).raise_for_status()
+        ok = len(statements) <= limit
+        failed = failed or not ok
+        print(f"{'ok' if ok else 'FAIL':>4} {url:<30} {len(statements)} queries (max {limit})")
+    sys.exit(1 if failed else 0)
+
+
+def check_replicas(args):
+    """
+    Lukureplikoiden reititys SQLite-tiedostokopioilla: GETit kiertää replikoita round robinina, replikaan ei voi
+    kirjoittaa (query_only), ja kirjoituksen jälkeen cookie pinnaa clientin primarylle myös cachen ohi.
+    Replikat on kopioita seedauksen jälkeiseltä hetkeltä, eli ne "laahaa" kaikkien myöhempien kirjoitusten verran.
+    Exit code 1 jos jokin tarkistus ei mene läpi.
+    """
+    if args.replicas is None:
+        # DB_REPLICA_URLS luetaan importissa -> lapsiprosessi, jolle replikoiden polut annetaan valmiiksi
+        paths = [os.path.join(BENCH_DIR, f"replica{n}.db") for n in range(2)]
+        env = dict(os.environ, DB_REPLICA_URLS=",".join(f"sqlite:///{path}" for path in paths), READ_YOUR_WRITES_SECONDS="5")
+        cmd = [sys.executable, "-m", "sql_app.bench", "replicas", "--replicas", *paths]
+        sys.exit(subprocess.run(cmd, env=env).returncode)
+
+    import sqlite3
+
+    from fastapi.testclient import TestClient
+    from sqlalchemy.exc import OperationalError
+
+    main = load_app()
+    with main.SessionLocal() as db:
+        seed(db, 10, items_per_user=1)
+    # replikoihin ei ole vielä otettu yhteyttä, joten kopiot voi tehdä vasta tässä
+    primary = sqlite3.connect(os.path.join(BENCH_DIR, "app.db"))
+    for path in args.replicas:
+        replica = sqlite3.connect(path)
+        primary.backup(replica)
+        replica.close()
+    primary.close()
+
+    failed = False
+
+    def check(name: str, ok: bool):
+        nonlocal failed
+        failed = failed or not ok
+        print(f"{'ok' if ok else 'FAIL':>4} {name}")
+
+    engines = [main.engine, *main.replica_engines]
+
+    def route(client, url):
+        # mille enginelle (0 = primary) pyynnön kyselyt meni
+        used = []
+        listeners = []
+        for index, engine in enumerate(engines):
+            def listener(*_, index=index):
+                used.append(index)
+            event.listen(engine, "before_cursor_execute", listener)
+            listeners.append((engine, listener))
+        try:
+            response = client.get(url)
+        finally:
+            for engine, listener in listeners:
+                event.remove(engine, "before_cursor_execute", listener)
+        return response, set(used)
+
+    anonymous = TestClient(main.app)
+    routed = [route(anonymous, f"/items/?limit=5&skip={n}")[1] for n in range(4)]
+    check(f"round robin: GETs went to engines {routed} (1, 2 = replicas)", routed == [{1}, {2}, {1}, {2}])
+
+    try:
+        with main.read_session() as db:
+            db.execute(insert(models.User).values(email="replica-write@bench.xyz", hashed_password="x", is_active=True))
+            db.commit()
+        check("query_only: replica refused a write", False)
+    except OperationalError as e:
+        check(f"query_only: replica refused a write ({e.orig})", "readonly" in str(e.orig))
+
+    writer = TestClient(main.app)
+    response = writer.post("/users/", json={"email": "new@bench.xyz", "password": "x"})
+    new_id = response.json()["id"]
+    check("write sets the db_primary cookie", "db_primary" in response.cookies)
+    check("unpinned client still reads the lagging replica (404)", anonymous.get(f"/users/{new_id}").status_code == 404)
+    response, used = route(writer, f"/users/{new_id}")
+    check(f"pinned client reads its own write from the primary ({response.status_code}, engines {used})", response.status_code == 200 and used == {0})
+
+    # cache: unpinned luku täyttää cachen replikalta, pinnattu ei saa nähdä sitä
+    writer.post("/users/1/items", json={"title": "written after the copy"}).raise_for_status()
+    stale = anonymous.get("/users/1").json()
+    fresh = writer.get("/users/1").json()
+    check(f"user cache: pinned read sees the new item ({len(fresh['items'])} items, replica-filled cache had {len(stale['items'])})",
+          len(fresh["items"]) == len(stale["items"]) + 1)
+    sys.exit(1 if failed else 0)
+
+
+async def drive(app, next_call, concurrency: int, requests: int, errors: list | None = None) -> tuple[float, list[float]]:
+    """
+    Ajaa requests kpl pyyntöjä appiin ASGI-transportin yli (ei verkkoa), concurrency:n rinnakkaisella workerilla.
+    next_call() palauttaa seuraavan pyynnön (method, url, json). Palauttaa (kokonaisaika s, latenssit ms).
+    Virheellinen vastaus kaataa ajon, paitsi jos errors-lista on annettu: silloin statuskoodit kerätään siihen.
+    """
+    import httpx
+
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=errors is None)
+    latencies = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        remaining = iter(range(requests))
+
+        async def worker():
+            for _ in remaining:
+                method, url, body = next_call()
+                start = time.perf_counter()
+                response = await client.request(method, url, json=body)
+                if errors is None:
+                    response.raise_for_status()
+                elif response.is_error:
+                    errors.append(response.status_code)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - start, latencies
+
+
+def percentile(samples: list[float], p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[int(p * (len(ordered) - 1))] if ordered else 0.0
+
+
+def bench_throughput(args):
+    if args.mode is None:
+        # moodi valitaan importissa, joten kumpikin ajetaan omassa prosessissaan
+        for mode in ("sync", "async"):
+            env = dict(os.environ, DB_ASYNC="1" if mode == "async" else "0")
+            cmd = [sys.executable, "-m", "sql_app.bench", "throughput", "--mode", mode,
+                   "--users", str(args.users), "--requests", str(args.requests),
+                   "--concurrency", *map(str, args.concurrency)]
+            subprocess.run(cmd, env=env, check=True)
+        return
+
+    main = load_app()
+    with main.SessionLocal() as db:
+        seed(db, args.users, items_per_user=3)
+    urls = [f"/users/{random.randint(1, args.users)}" for _ in range(100)] + ["/users/?limit=20", "/items/?limit=20"]
+    calls = [("GET", url, None) for url in urls]
+    for concurrency in args.concurrency:
+        elapsed, _ = asyncio.run(drive(main.app, lambda: random.choice(calls), concurrency, args.requests))
+        print(f"{args.mode:>5} concurrency={concurrency:<5} {args.requests / elapsed:>8.0f} req/s")
+
+
+def bench_bulk(args):
+    from fastapi.testclient import TestClient
+
+    main = load_app()
+    client = TestClient(main.app)
+    user_id = client.post("/users/", json={"email": "owner@bench.xyz", "password": "x"}).json()["id"]
+    items = [{"title": f"item {i}", "description": "bulk bench"} for i in range(args.rows)]
+
+    start = time.perf_counter()
+    for item in items:
+        client.post(f"/users/{user_id}/items", json=item).raise_for_status()
+    single = args.rows / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    client.post(f"/users/{user_id}/items/bulk", json=items).raise_for_status()
+    bulk = args.rows / (time.perf_counter() - start)
+
+    users = [{"email": f"bulk{i}@bench.xyz", "password": "x"} for i in range(args.rows)]
+    start = time.perf_counter()
+    client.post("/users/bulk", json=users).raise_for_status()
+    bulk_users = args.rows / (time.perf_counter() - start)
+
+    print(f"single item POST   {single:>10.0f} rows/s")
+    print(f"bulk items POST    {bulk:>10.0f} rows/s ({bulk / single:.0f}x)")
+    print(f"bulk users POST    {bulk_users:>10.0f} rows/s")
+
+
+def bench_coalesce(args):
+    if args.mode is None:
+        for mode in ("off", "on"):
+            env = dict(os.environ, ITEM_WRITE_BATCH="1" if mode == "on" else "0")
+            cmd = [sys.executable, "-m", "sql_app.bench", "coalesce", "--mode", mode,
+                   "--requests", str(args.requests), "--concurrency", *map(str, args.concurrency)]
+            subprocess.run(cmd, env=env, check=True)
+        return
+
+    main = load_app()
+    with main.SessionLocal() as db:
+        seed(db, 100)
+    calls = [("POST", f"/users/{user_id}/items", {"title": "coalesced", "description": "bench"}) for user_id in range(1, 101)]
+    for concurrency in args.concurrency:
+        elapsed, _ = asyncio.run(drive(main.app, lambda: random.choice(calls), concurrency, args.requests))
+        print(f"batching {args.mode:>3} concurrency={concurrency:<5} {args.requests / elapsed:>8.0f} items/s")
+
+
+def bench_shards(args):
+    """
+    Shardatut ydinreitit (DB_SHARD_URLS) paikallisilla SQLite-tiedostoilla: item-POSTien läpimeno shardimäärän
+    mukaan, ja tarkistus että fan-out-listat antaa kaikki rivit kerran ja id-järjestyksessä ja että bulk-, export- ja
+    hakureitit toimii. Exit 1 jos ei.
+    """
+    if args.shards is None:
+        failed = False
+        for shards in args.counts:
+            # shardien tiedostot tämän prosessin BENCH_DIRiin, jotta atexit siivoaa ne
+            urls = [f"sqlite:///{os.path.join(BENCH_DIR, f'shard{shards}-{i}.db')}" for i in range(shards)]
+            env = dict(os.environ, DB_SHARD_URLS=",".join(urls),
+                       DB_SHARD_DIRECTORY_URL=f"sqlite:///{os.path.join(BENCH_DIR, f'directory{shards}.db')}")
+            cmd = [sys.executable, "-m", "sql_app.bench", "shards", "--shards", str(shards),
+                   "--users", str(args.users), "--requests", str(args.requests), "--concurrency", str(args.concurrency)]
+            failed = subprocess.run(cmd, env=env).returncode != 0 or failed
+        sys.exit(1 if failed else 0)
+
+    from fastapi.testclient import TestClient
+
+    from . import sharding
+
+    main = load_app()
+    client = TestClient(main.app)
+    user_ids = [client.post("/users/", json={"email": f"user{i}@bench.xyz", "password": "x"}).json()["id"] for i in range(args.users)]
+    calls = [("POST", f"/users/{user_id}/items", {"title": "sharded", "description": "bench"}) for user_id in user_ids]
+    elapsed, latencies = asyncio.run(drive(main.app, lambda: random.choice(calls), args.concurrency, args.requests))
+
+    seen, cursor = [], None
+    while True:
+        response = client.get("/items/?limit=100" + (f"&cursor={cursor}" if cursor else ""))
+        seen.extend(item["id"] for item in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    total = int(response.headers["X-Total-Count"])
+    users_page = [user["id"] for user in client.get(f"/users/?limit={args.users}").json()]
+    per_shard = [
+        engine.connect().execute(text("SELECT count(*) FROM items")).scalar() for engine in sharding.shard_engines
+    ]
+    offset_page = [item["id"] for item in client.get("/items/?skip=50&limit=30").json()]
+    too_deep = client.get(f"/items/?skip={sharding.SHARD_MAX_SKIP + 1}").status_code
+    # bulk, export ja haku: myös nämä reitit pitää olla shardattuna
+    bulk = client.post("/users/bulk", json=[{"email": f"bulk{i % 5}@bench.xyz", "password": "x"} for i in range(6)]).json()
+    bulk_ids = [result["id"] for result in bulk if result["ok"]]
+    items_bulk = client.post(f"/users/{bulk_ids[0]}/items/bulk", json=[{"title": "needle", "description": "bulk"}] * 3).json()
+    exported = [json.loads(line)["id"] for line in client.get("/items/export").text.splitlines()]
+    exported_users = [json.loads(line)["id"] for line in client.get("/users/export").text.splitlines()]
+    found = client.get("/items/search?q=needle").json()
+    extras_ok = (len(bulk_ids) == 5 and not bulk[5]["ok"] and all(result["ok"] for result in items_bulk)
+                 and exported == sorted(seen + [result["id"] for result in items_bulk])
+                 and exported_users == sorted(user_ids + bulk_ids)
+                 and sorted(item["id"] for item in found) == sorted(result["id"] for result in items_bulk))
+    ok = (seen == sorted(set(seen)) and len(seen) == total == args.requests and users_page == sorted(user_ids)
+          and offset_page == seen[50:80] and too_deep == 400 and extras_ok)
+    print(f"shards={args.shards} {args.requests / elapsed:>8.0f} items/s  p99 {percentile(latencies, 0.99):>6.1f} ms"
+          f"  items per shard {per_shard}  {'ok' if ok else 'FAIL: fan-out lists or bulk/export/search routes wrong'}")
+    sys.exit(0 if ok else 1)
+
+
+def bench_pool(args):
+    """
+    Poolin kuormitus lukureiteillä: sessio suljetaan heti handlerin jälkeen (DB_RELEASE_EARLY=1) vs vasta kun
+    vastaus on lähetetty. Pieni pooli ilman overflowta ja user-cache pois, jotta jokainen pyyntö tarvii yhteyden.
+    """
+    if args.mode is None:
+        for mode in ("late", "early"):
+            # lyhyt pool timeout: jos yhteydet jumittuu, se näkyy virheinä eikä 30 s odotuksina
+            env = dict(os.environ, DB_RELEASE_EARLY="1" if mode == "early" else "0", USER_CACHE_SIZE="0",
+                       DB_POOL_SIZE=str(args.pool_size), DB_MAX_OVERFLOW="0", DB_POOL_TIMEOUT="2")
+            cmd = [sys.executable, "-m", "sql_app.bench", "pool", "--mode", mode, "--requests", str(args.requests),
+                   "--concurrency", *map(str, args.concurrency)]
+            subprocess.run(cmd, env=env, check=True)
+        return
+
+    from .database import pool_key, pool_metrics, reset_pool_metrics
+
+    main = load_app()
+    with main.SessionLocal() as db:
+        seed(db, 1000, items_per_user=3)
+    calls = [("GET", f"/users/{user_id}", None) for user_id in range(1, 1001)] + [("GET", "/items/?limit=20", None)] * 100
+    for concurrency in args.concurrency:
+        reset_pool_metrics()
+        errors = []
+        elapsed, latencies = asyncio.run(drive(main.app, lambda: random.choice(calls), concurrency, args.requests, errors))
+        stats = pool_metrics[pool_key(main.engine)].stats()
+        print(f"{args.mode:>5} concurrency={concurrency:<4} {args.requests / elapsed:>7.0f} req/s  p99 {percentile(latencies, 0.99):>7.1f} ms"
+              f"  checkout wait avg {stats['wait_avg_ms']:>6.2f} ms max {stats['wait_max_ms']:>7.1f} ms  errors {len(errors)}")
+
+
+def bench_serialize(args):
+    """
+    CPU-aika per 1000 riviä GET /users/ ja GET /items/ -listoille, response_model-polku vs FAST_JSON.
+    Lopuksi tarkistetaan, että molemmat polut antaa tavu tavulta saman vastauksen.
+    """
+    if args.mode is None:
+        digests = {}
+        for mode in ("orm", "fast"):
+            env = dict(os.environ, FAST_JSON="1" if mode == "fast" else "0")
+            cmd = [sys.executable, "-m", "sql_app.bench", "serialize", "--mode", mode, "--repeat", str(args.repeat)]
+            output = subprocess.run(cmd, env=env, check=True, capture_output=True, text=True).stdout
+            print(output, end="")
+            digests[mode] = [line for line in output.splitlines() if line.startswith("sha256")]
+        print("byte-identical:", digests["orm"] == digests["fast"])
+        return
+
+    import hashlib
+
+    from fastapi.testclient import TestClient
+
+    main = load_app()
+    with main.SessionLocal() as db:
+        seed(db, 1000, items_per_user=5)
+    client = TestClient(main.app)
+    for url, rows in (("/users/?limit=1000", 1000 + 5000), ("/items/?limit=1000", 1000)):
+        body = client.get(url).content
+        start = time.process_time()
+        for _ in range(args.repeat):
+            client.get(url).raise_for_status()
+        cpu_ms = (time.process_time() - start) * 1000 / args.repeat
+        print(f"{args.mode:>4} {url:<22} {cpu_ms / rows * 1000:>8.2f} ms CPU / 1000 rows")
+        print(f"sha256 {url} {hashlib.sha256(body).hexdigest()}")
+
+
+def check_plans(args):
+    """
+    Ajaa crud:n kuumat kyselyt, ja EXPLAIN QUERY PLAN jokaiselle SQL-lauseelle jonka ne tuottaa.
+    Exit code 1 jos jokin päätyy full table scaniin ("SCAN taulu" ilman indeksiä).
+    Exportit ja vanha skip/limit-sivutus puuttuu tarkoituksella, ne lukee taulun järjestyksessä joka tapauksessa.
+    """
+    SessionLocal = make_session(os.path.join(BENCH_DIR, "plans.db"))
+    with SessionLocal() as db:
+        seed(db, 1000, items_per_user=3)
+
+    hot = {
+        "get_user": lambda db: crud.get_user(db, user_id=500),
+        "get_user_by_email": lambda db: crud.get_user_by_email(db, email="user10@bench.xyz"),
+        "get_users (cursor)": lambda db: crud.get_users(db, limit=50, after_id=500),
+        "get_items (cursor)": lambda db: crud.get_items(db, limit=50, after_id=500),
+        "get_items (owner)": lambda db: crud.get_items(db, limit=50, after_id=10, owner_id=7),
+        "get_count": lambda db: crud.get_count(db, crud.items_counter(owner_id=7)),
+        "get_user_version": lambda db: crud.get_user_version(db, user_id=500),
+        "get_item_versions (owner)": lambda db: crud.get_item_versions(db, limit=50, after_id=10, owner_id=7),
+        "user_exists": lambda db: crud.user_exists(db, user_id=500),
+        "create_users (email check)": lambda db: crud._existing_emails(db, ["user1@bench.xyz", "user2@bench.xyz"]),
+    }
+
+    failed = False
+    for name, fn in hot.items():
+        crud.user_cache.clear()
+        with SessionLocal() as db:
+            engine = db.get_bind()
+            captured = []
+
+            def capture(conn, cursor, statement, parameters, context, executemany):
+                captured.append((statement, parameters))
+
+            event.listen(engine, "before_cursor_execute", capture)
+            try:
+                fn(db)
+            finally:
+                event.remove(engine, "before_cursor_execute", capture)
+
+            with engine.connect() as conn:
+                for statement, parameters in captured:
+                    if not statement.lstrip().upper().startswith("SELECT"):
+                        continue
+                    plan = [row[3] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+                    # "SCAN anon_1" tms. on alikyselyn tulos, ei taulu
+                    scans = [
+                        step for step in plan
+                        if step.startswith("SCAN") and step.split()[1] in models.Base.metadata.tables and "USING" not in step
+                    ]
+                    failed = failed or bool(scans)
+                    print(f"{'FAIL' if scans else 'ok':>4} {name:<28} {' | '.join(plan)}")
+    sys.exit(1 if failed else 0)
+
+
+def bench_search(args):
+    # sanasto, jossa on yleisiä ja harvinaisia sanoja, jotta haut osuu eri kokoisiin tulosjoukkoihin
+    rng = random.Random(1)
+    common = ["red", "blue", "green", "small", "large", "old", "new", "cheap", "fast", "quiet"]
+    rare = [f"thing{n}" for n in range(50_000)]
+    words = common + rare
+    # indeksi luodaan vasta datan jälkeen (rebuild), se on paljon nopeampaa kuin triggerit rivi kerrallaan
+    SessionLocal = make_session(os.path.join(BENCH_DIR, "search.db"), search_index=False)
+    with SessionLocal() as db:
+        seed(db, 1000)
+        chunk = 50_000
+        for start in range(0, args.rows, chunk):
+            rows = [
+                {
+                    "title": f"{rng.choice(common)} {rng.choice(rare)}",
+                    "description": " ".join(rng.choice(words) for _ in range(8)),
+                    "owner_id": rng.randint(1, 1000),
+                }
+                for _ in range(min(chunk, args.rows - start))
+            ]
+            db.execute(insert(models.Item), rows)
+        db.commit()
+        models.create_search_index(db.get_bind())
+
+        print(f"{'query':<20} {'hits':>8} {'ms (limit 20)':>14}")
+        for q in ["thing123", "red thing42", "blue", "red green small"]:
+            hits = db.execute(text("SELECT count(*) FROM items_fts WHERE items_fts MATCH :q"), {"q": crud.fts_query(q)}).scalar()
+            ms = timed(lambda: crud.search_items(db, q=q, limit=20), args.repeat)
+            print(f"{q:<20} {hits:>8} {ms:>14.2f}")
+
+
+def load_calls(users: int) -> dict:
+    # jokaiselle sql_appin endpointille generaattori, joka antaa seuraavan pyynnön (method, url, json)
+    emails = itertools.count()
+    rand_user = lambda: random.randint(1, users)  # noqa: E731
+    item = {"title": "load test item", "description": "red bike"}
+    return {
+        "POST /users/": lambda: ("POST", "/users/", {"email": f"load{next(emails)}@bench.xyz", "password": "x"}),
+        "POST /users/bulk": lambda: ("POST", "/users/bulk", [{"email": f"load{next(emails)}@bench.xyz", "password": "x"} for _ in range(50)]),
+        "GET /users/": lambda: ("GET", f"/users/?skip={rand_user()}&limit=20", None),
+        "GET /users/ (cursor)": lambda: ("GET", f"/users/?cursor={crud.encode_cursor(rand_user())}&limit=20", None),
+        "GET /users/{id}": lambda: ("GET", f"/users/{rand_user()}", None),
+        "GET /users/export": lambda: ("GET", "/users/export", None),
+        "POST /users/{id}/items": lambda: ("POST", f"/users/{rand_user()}/items", item),
+        "POST /users/{id}/items/bulk": lambda: ("POST", f"/users/{rand_user()}/items/bulk", [item] * 50),
+        "GET /items/": lambda: ("GET", f"/items/?skip={rand_user()}&limit=20", None),
+        "GET /items/ (cursor)": lambda: ("GET", f"/items/?cursor={crud.encode_cursor(rand_user())}&limit=20", None),
+        "GET /items/search": lambda: ("GET", f"/items/search?q=item{rand_user()}", None),
+        "GET /items/export": lambda: ("GET", "/items/export", None),
+    }
+
+
+def bench_load(args):
+    """
+    Kuormitustesti koko API:lle prosessin sisällä: seedaa kannan, ajaa jokaista endpointtia vuorollaan
+    --concurrency rinnakkaisuudella ja raportoi p50/p95/p99, req/s ja SQL-kyselyt per pyyntö.
+    --out tallentaa tuloksen JSONiksi, jota compare vertaa.
+    """
+    main = load_app()
+    with main.SessionLocal() as db:
+        seed(db, args.users, items_per_user=args.items_per_user)
+
+    results = {}
+    print(f"{'endpoint':<30} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'q/req':>6}")
+    for name, next_call in load_calls(args.users).items():
+        if args.only and not any(part in name for part in args.only):
+            continue
+        # exportit lukee koko taulun, joten niitä ajetaan vähemmän
+        requests = max(1, args.requests // 20) if name.endswith("export") else args.requests
+        with count_queries(main.engine) as statements:
+            elapsed, latencies = asyncio.run(drive(main.app, next_call, min(args.concurrency, requests), requests))
+        results[name] = {
+            "requests": requests,
+            "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "rps": requests / elapsed,
+            "queries_per_request": len(statements) / requests,
+        }
+        r = results[name]
+        print(f"{name:<30} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['rps']:>8.0f} {r['queries_per_request']:>6.2f}")
+
+    if args.out:
+        config = {"users": args.users, "items_per_user": args.items_per_user, "concurrency": args.concurrency, "requests": args.requests}
+        with open(args.out, "w") as f:
+            json.dump({"config": config, "endpoints": results}, f, indent=2)
+        print(f"saved {args.out}")
+
+
+def compare_runs(args):
+    """
+    Vertaa kahta bench load --out -tulosta. Exit code 1 jos jokin endpoint hidastui (p95 tai req/s) yli
+    --tolerance:n verran, tai teki enemmän kyselyjä per pyyntö kuin ennen.
+    """
+    with open(args.base) as f:
+        base = json.load(f)["endpoints"]
+    with open(args.new) as f:
+        new = json.load(f)["endpoints"]
+
+    failed = False
+    print(f"{'endpoint':<30} {'p95 ms':>17} {'req/s':>15} {'q/req':>13}")
+    for name in [name for name in base if name in new]:
+        b, n = base[name], new[name]
+        regressions = []
+        if n["p95_ms"] > b["p95_ms"] * (1 + args.tolerance):
+            regressions.append("p95")
+        if n["rps"] < b["rps"] * (1 - args.tolerance):
+            regressions.append("rps")
+        if n["queries_per_request"] > b["queries_per_request"] + 0.01:
+            regressions.append("queries")
+        failed = failed or bool(regressions)
+        print(
+            f"{name:<30} {b['p95_ms']:>7.2f} -> {n['p95_ms']:>7.2f} {b['rps']:>6.0f} -> {n['rps']:>6.0f} "
+            f"{b['queries_per_request']:>5.2f} -> {n['queries_per_request']:>5.2f} {'REGRESSION ' + ','.join(regressions) if regressions else ''}"
+        )
+    sys.exit(1 if failed else 0)
+
+
+def bench_overhead(args):
+    """
+    Per-kutsu -kustannus crud:n lukufunktioille: vanha db.query(...).filter(...) joka kutsulla vs
+    crud:n valmiiksi rakennetut select()-statementit bindparameilla. Pieni kanta, jotta ero on enimmäkseen
+    Pythonin puolella (statementin rakennus + cache key), ei SQLitessä. User-cache on pois päältä.
+    """
+    from sqlalchemy.orm import joinedload, selectinload
+
+    from .cache import LRUCache
+
+    SessionLocal = make_session(os.path.join(BENCH_DIR, "overhead.db"), search_index=False)
+    with SessionLocal() as db:
+        seed(db, 1000, items_per_user=3)
+    crud.user_cache = LRUCache(maxsize=0)
+    User, Item = models.User, models.Item
+
+    legacy = {
+        "get_user": lambda db: db.query(User).options(joinedload(User.items)).filter(User.id == 500).first(),
+        "get_user_by_email": lambda db: db.query(User.id).filter(User.email == "user10@bench.xyz").scalar(),
+        "get_users (cursor)": lambda db: db.query(User).options(selectinload(User.items)).order_by(User.id).filter(User.id > 500).limit(20).all(),
+        "get_items (cursor)": lambda db: db.query(Item).order_by(Item.id).filter(Item.id > 500).limit(20).all(),
+        "get_items (offset)": lambda db: db.query(Item).order_by(Item.id).offset(500).limit(20).all(),
+    }
+    prebuilt = {
+        "get_user": lambda db: crud.get_user(db, user_id=500),
+        "get_user_by_email": lambda db: db.scalar(crud.USER_ID_BY_EMAIL, {"email": "user10@bench.xyz"}),
+        "get_users (cursor)": lambda db: crud.get_users(db, limit=20, after_id=500),
+        "get_items (cursor)": lambda db: crud.get_items(db, limit=20, after_id=500),
+        "get_items (offset)": lambda db: crud.get_items(db, skip=500, limit=20),
+    }
+
+    def ids(result):
+        return [row.id for row in result] if isinstance(result, list) else getattr(result, "id", result)
+
+    def per_call_us(fn, db) -> float:
+        for _ in range(50):  # lämmitys: compile-cache täyteen
+            fn(db)
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for _ in range(args.calls):
+                fn(db)
+            best = min(best, (time.perf_counter() - start) / args.calls * 1e6)
+        return best
+
+    print(f"{'query':<22} {'legacy us':>10} {'prebuilt us':>12} {'speedup':>8}")
+    with SessionLocal() as db:
+        for name in legacy:
+            # get_user palauttaa schemas.User:n ja vanha ORM-objektin -> verrataan vain id:itä
+            assert ids(legacy[name](db)) == ids(prebuilt[name](db)), name
+            legacy_us = per_call_us(legacy[name], db)
+            prebuilt_us = per_call_us(prebuilt[name], db)
+            print(f"{name:<22} {legacy_us:>10.1f} {prebuilt_us:>12.1f} {legacy_us / prebuilt_us:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m sql_app.bench")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("pagination", help="deep page latency: skip/limit vs cursor")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--limit", type=int, default=100)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(fn=bench_pagination)
+
+    p = sub.add_parser("queries", help="check queries per request stay constant")
+    p.add_argument("--users", type=int, default=100)
+    p.set_defaults(fn=check_queries)
+
+    p = sub.add_parser("replicas", help="check read-replica routing, query_only and cookie pinning on SQLite file copies")
+    p.add_argument("--replicas", nargs="+", default=None, help=argparse.SUPPRESS)
+    p.set_defaults(fn=check_replicas)
+
+    p = sub.add_parser("throughput", help="req/s for sync vs async (DB_ASYNC) routes")
+    p.add_argument("--mode", choices=["sync", "async"], default=None)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--requests", type=int, default=3000)
+    p.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 1000])
+    p.set_defaults(fn=bench_throughput)
+
+    p = sub.add_parser("bulk", help="rows/s: one POST per item vs bulk endpoints")
+    p.add_argument("--rows", type=int, default=2000)
+    p.set_defaults(fn=bench_bulk)
+
+    p = sub.add_parser("coalesce", help="item POST throughput with/without group commit (ITEM_WRITE_BATCH)")
+    p.add_argument("--mode", choices=["off", "on"], default=None)
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 40])
+    p.set_defaults(fn=bench_coalesce)
+
+    p = sub.add_parser("shards", help="sharded routes: item POST throughput per shard count, fan-out list check")
+    p.add_argument("--counts", type=int, nargs="+", default=[1, 4])
+    p.add_argument("--shards", type=int, default=None, help=argparse.SUPPRESS)
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--requests", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=40)
+    p.set_defaults(fn=bench_shards)
+
+    p = sub.add_parser("pool", help="pool pressure: release sessions before vs after sending the response")
+    p.add_argument("--mode", choices=["late", "early"], default=None)
+    p.add_argument("--pool-size", type=int, default=5)
+    p.add_argument("--requests", type=int, default=3000)
+    p.add_argument("--concurrency", type=int, nargs="+", default=[10, 50])
+    p.set_defaults(fn=bench_pool)
+
+    p = sub.add_parser("serialize", help="CPU time per 1000 rows: response_model vs FAST_JSON list responses")
+    p.add_argument("--mode", choices=["orm", "fast"], default=None)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(fn=bench_serialize)
+
+    p = sub.add_parser("plans", help="EXPLAIN QUERY PLAN for crud's hot queries, fails on full table scans")
+    p.set_defaults(fn=check_plans)
+
+    p = sub.add_parser("search", help="FTS5 search latency on a big items table")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(fn=bench_search)
+
+    p = sub.add_parser("load", help="load test every endpoint in-process: latency percentiles, req/s, queries/request")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--items-per-user", type=int, default=5)
+    p.add_argument("--concurrency", type=int, default=20)
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--only", nargs="*", help="run only endpoints whose name contains one of these")
+    p.add_argument("--out", help="save results as JSON")
+    p.set_defaults(fn=bench_load)
+
+    p = sub.add_parser("compare", help="compare two 'load --out' results, exit 1 on regression")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--tolerance", type=float, default=0.10)
+    p.set_defaults(fn=compare_runs)
+
+    p = sub.add_parser("overhead", help="per-call overhead of crud reads: legacy db.query() vs prebuilt select()")
+    p.add_argument("--calls", type=int, default=500)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(fn=bench_overhead)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,291 @@
-from sqlalchemy.orm import Session
+import base64
+import binascii
+import os
+
+from sqlalchemy import bindparam, insert, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, selectinload
 from . import models, schemas
+from .cache import CacheBackend, LRUCache
 
 """
 Kantsii luoda erikseen, eikä polkuun, jotta voi käyttää kans testeihin
 """
 
+"""
+Keyset- eli cursor-sivutus: offset(skip) joutuu käymään läpi ja heittämään pois kaikki skipatut rivit,
+joten syvät sivut hidastuu lineaarisesti. Cursorilla jatketaan suoraan viimeisen nähdyn id:n jälkeen
+primary key -indeksiä pitkin, jolloin jokainen sivu maksaa about saman verran.
+Cursor on clientille läpinäkymätön (base64), ettei siihen ala kukaan nojata.
+"""
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def next_cursor(rows: list, limit: int) -> str | None:
+    # täysi sivu -> voi olla lisää, vajaa sivu -> loppu. Rivit voi olla ORM-objekteja tai dictejä (*_rows)
+    if limit and len(rows) == limit:
+        last = rows[-1]
+        return encode_cursor(last["id"] if isinstance(last, dict) else last.id)
+    return None
+
+
+"""
+User.items ladataan etukäteen, muuten jokainen user lataa itemsit lazyna omalla kyselyllään (N+1).
+Yksittäiselle userille joinedload = yksi kysely, listalle selectinload = kaksi kyselyä sivun koosta
+riippumatta (joinedload + limit monistaisi user-rivit joka itemille).
+"""
+
+"""
+Lukukyselyt on rakennettu valmiiksi moduulin latauksessa, ja arvot (id, limit, cursor...) annetaan bindparameina
+executessa. Näin kutsu ei rakenna joka kerta uutta db.query(...).filter(...) -ketjua, vaan SQLAlchemyn
+compile-cache osuu suoraan samaan statementiin. Sivutuksesta on kaksi versiota (offset ja keyset),
+koska limit/offset ja where-ehto ovat osa SQL:ää eikä pelkkiä arvoja. Mittaus: python -m sql_app.bench overhead
+"""
+
+
+def _page(query, id_column):
+    # -> (offset-sivu, keyset-sivu), parametrit _page_params:sta
+    query = query.order_by(id_column)
+    return (
+        query.offset(bindparam("skip")).limit(bindparam("limit")),
+        query.where(id_column > bindparam("after_id")).limit(bindparam("limit")),
+    )
+
+
+def _page_params(skip: int, limit: int, after_id: int | None) -> dict:
+    if after_id is not None:
+        return {"after_id": after_id, "limit": limit}
+    return {"skip": skip, "limit": limit}
+
+
+def _pick(pages: tuple, after_id: int | None):
+    return pages[after_id is not None]
+
+
+USER_BY_ID = select(models.User).options(joinedload(models.User.items)).where(models.User.id == bindparam("user_id"))
+USER_ID_BY_EMAIL = select(models.User.id).where(models.User.email == bindparam("email"))
+USER_EXISTS = select(models.User.id).where(models.User.id == bindparam("user_id"))
+USERS_PAGE = _page(select(models.User).options(selectinload(models.User.items)), models.User.id)
+ITEMS_PAGE = _page(select(models.Item), models.Item.id)
+OWNER_ITEMS_PAGE = _page(select(models.Item).where(models.Item.owner_id == bindparam("owner_id")), models.Item.id)
+COUNTER_VALUE = select(models.Counter.value).where(models.Counter.name == bindparam("name"))
+USER_VERSION = select(models.User.version).where(models.User.id == bindparam("user_id"))
+USER_VERSIONS_PAGE = _page(select(models.User.id, models.User.version), models.User.id)
+_item_versions = select(models.Item.id, models.Item.version)
+ITEM_VERSIONS_PAGE = _page(_item_versions, models.Item.id)
+OWNER_ITEM_VERSIONS_PAGE = _page(_item_versions.where(models.Item.owner_id == bindparam("owner_id")), models.Item.id)
+
+"""
+get_user ja get_user_by_email menee cachen kautta (USER_CACHE_SIZE=0 ottaa pois käytöstä).
+Cacheen tallennetaan valmis schemas.User, ei ORM-objektia, koska se on sidottu sessioon.
+"user:<id>" -> (schemas.User, versio) ja "email:<email>" -> id, eli userin data on vain yhdessä paikassa
+ja invalidointiin riittää id. Kirjoitukset invalidoi, TTL rajaa muiden prosessien aiheuttaman vanhentumisen.
+Replikoiden kanssa cache voi täyttyä replikalta, joka ei ole vielä saanut viimeisintä kirjoitusta. Siksi
+primarylle pinnattu lukija (fresh=True, ks. main.py) ohittaa cachen ja päivittää sen primaryn tuoreella rivillä.
+"""
+user_cache: CacheBackend = LRUCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "30")),
+)
+
+
+def invalidate_user(user_id: int):
+    user_cache.delete(f"user:{user_id}")
+
+
+def get_user_with_version(db: Session, user_id: int, fresh: bool = False) -> tuple[schemas.User, int] | None:
+    key = f"user:{user_id}"
+    entry = None if fresh else user_cache.get(key)
+    if entry is None:
+        # joinedload + collection -> unique(), ja ilman LIMITiä ei tule alikyselyä user-rivin ympärille
+        db_user = db.scalars(USER_BY_ID, {"user_id": user_id}).unique().one_or_none()
+        if db_user is None:
+            return None
+        entry = (schemas.User.from_orm(db_user), db_user.version)
+        user_cache.set(key, entry)
+    return entry
+
+
 def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    entry = get_user_with_version(db, user_id=user_id)
+    return None if entry is None else entry[0]
+
+
+def get_user_version(db: Session, user_id: int, fresh: bool = False) -> int | None:
+    # If-None-Matchin tarkistukseen: cachesta jos siellä on, muuten pelkkä PK-haku ilman itemejä
+    entry = None if fresh else user_cache.get(f"user:{user_id}")
+    if entry is not None:
+        return entry[1]
+    return db.scalar(USER_VERSION, {"user_id": user_id})
 
 
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    key = f"email:{email}"
+    user_id = user_cache.get(key)
+    if user_id is None:
+        user_id = db.scalar(USER_ID_BY_EMAIL, {"email": email})
+        if user_id is None:
+            return None
+        user_cache.set(key, user_id)
+    return get_user(db, user_id=user_id)
+
 
+def get_users(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    return db.scalars(_pick(USERS_PAGE, after_id), _page_params(skip, limit, after_id)).all()
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+
+"""
+create_user: ei erillistä SELECTiä emailin tarkistukseen eikä refreshiä, vaan yksi INSERT ... RETURNING + commit.
+Tuplaemailin huomaa unique-indeksi (IntegrityError), jolloin ei ole myöskään kilpatilannetta tarkistuksen ja insertin välissä.
+Palauttaa None jos email on jo käytössä.
+"""
 
 
 def create_user(db: Session, user: schemas.UserRequest):
     fake_hash = user.password + "not-really-a-hash"
-    db_user = models.User(email=user.email, hashed_password=fake_hash)
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user) # refreshi liittää db:stä dataa, esim. luodun id:n
-    # return Model ilman hashia?
-    return db_user
+    statement = (
+        insert(models.User)
+        .values(email=user.email, hashed_password=fake_hash, is_active=True)
+        .returning(models.User.id, models.User.is_active)
+    )
+    try:
+        row = db.execute(statement).one()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+    user_cache.delete(f"email:{user.email}")
+    # uudella userilla ei ole vielä itemejä, joten vastauksen voi koota suoraan RETURNINGista
+    return schemas.User(id=row.id, email=user.email, is_active=row.is_active, items=[])
+
+
+"""
+Bulk-insertit: koko erä yhdessä transaktiossa ja yhdellä executemany-tyylisellä INSERT ... RETURNING:lla
+(SQLAlchemy 2.0 "insertmanyvalues"), eli yksi commit/fsync koko erälle eikä refreshiä per rivi.
+"""
+
+IN_CHUNK = 500  # SQLiten bind-parametrien raja
+
+
+def _existing_emails(db: Session, emails: list[str]) -> set[str]:
+    found = set()
+    for start in range(0, len(emails), IN_CHUNK):
+        chunk = emails[start:start + IN_CHUNK]
+        found.update(db.scalars(select(models.User.email).where(models.User.email.in_(chunk))))
+    return found
+
+
+def create_users(db: Session, users: list[schemas.UserRequest]) -> list[schemas.BulkResult]:
+    results = [None] * len(users)
+    taken = _existing_emails(db, list({user.email for user in users}))
+    rows, indexes = [], []
+    for i, user in enumerate(users):
+        if user.email in taken:
+            results[i] = schemas.BulkResult(index=i, ok=False, error="Email already in use")
+            continue
+        taken.add(user.email)
+        rows.append({"email": user.email, "hashed_password": user.password + "not-really-a-hash", "is_active": True})
+        indexes.append(i)
+
+    if rows:
+        # sort_by_parameter_order pakottaisi SQLitellä rivi kerrallaan -insertteihin, joten id:t yhdistetään emailin kautta
+        statement = insert(models.User).returning(models.User.id, models.User.email)
+        try:
+            ids_by_email = dict((email, user_id) for user_id, email in db.execute(statement, rows))
+            ids = [ids_by_email[row["email"]] for row in rows]
+            db.commit()
+        except IntegrityError:
+            # joku ehti lisätä saman emailin välissä -> rivi kerrallaan savepointeilla, saman transaktion sisällä
+            db.rollback()
+            ids = []
+            for row in rows:
+                try:
+                    with db.begin_nested():
+                        ids.append(db.scalar(insert(models.User).returning(models.User.id), row))
+                except IntegrityError:
+                    ids.append(None)
+            db.commit()
+        for i, user_id in zip(indexes, ids):
+            if user_id is None:
+                results[i] = schemas.BulkResult(index=i, ok=False, error="Email already in use")
+            else:
+                results[i] = schemas.BulkResult(index=i, ok=True, id=user_id)
+    return results
+
+
+"""
+*_rows: samat sivut kuin get_users/get_items, mutta pelkkinä dicteinä suoraan sarakkeista, ilman ORM-objekteja
+(fastjson.py:n nopeaa polkua varten). Kentät ja niiden järjestys tulee schemoista, jotta JSON on sama kuin response_modelilla.
+"""
+
+ITEM_FIELDS = list(schemas.Item.__fields__)
+USER_FIELDS = [field for field in schemas.User.__fields__ if field != "items"]
+
+
+_item_columns = select(*(getattr(models.Item, field) for field in ITEM_FIELDS))
+ITEM_ROWS_PAGE = _page(_item_columns, models.Item.id)
+OWNER_ITEM_ROWS_PAGE = _page(_item_columns.where(models.Item.owner_id == bindparam("owner_id")), models.Item.id)
+USER_ROWS_PAGE = _page(select(*(getattr(models.User, field) for field in USER_FIELDS)), models.User.id)
+# expanding bindparam: IN-listan pituus vaihtelee, mutta statement on silti sama
+ITEM_ROWS_BY_OWNERS = _item_columns.where(models.Item.owner_id.in_(bindparam("owner_ids", expanding=True))).order_by(models.Item.id)
+
+
+def get_items_rows(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None, owner_id: int | None = None) -> list[dict]:
+    params = _page_params(skip, limit, after_id)
+    if owner_id is None:
+        statement = _pick(ITEM_ROWS_PAGE, after_id)
+    else:
+        statement = _pick(OWNER_ITEM_ROWS_PAGE, after_id)
+        params["owner_id"] = owner_id
+    return [dict(zip(ITEM_FIELDS, row)) for row in db.execute(statement, params)]
+
+
+def get_users_rows(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None) -> list[dict]:
+    rows = db.execute(_pick(USER_ROWS_PAGE, after_id), _page_params(skip, limit, after_id))
+    users = [dict(zip(USER_FIELDS, row), items=[]) for row in rows]
+    by_id = {user["id"]: user for user in users}
+    ids = list(by_id)
+    for start in range(0, len(ids), IN_CHUNK):
+        for row in db.execute(ITEM_ROWS_BY_OWNERS, {"owner_ids": ids[start:start + IN_CHUNK]}):
+            item = dict(zip(ITEM_FIELDS, row))
+            by_id[item["owner_id"]]["items"].append(item)
+    return users
+
+
+def get_user_versions(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None) -> list[tuple[int, int]]:
+    # (id, versio) samalle sivulle kuin get_users, listan ETagia varten
+    return db.execute(_pick(USER_VERSIONS_PAGE, after_id), _page_params(skip, limit, after_id)).all()
+
+
+def get_item_versions(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None, owner_id: int | None = None) -> list[tuple[int, int]]:
+    params = _page_params(skip, limit, after_id)
+    if owner_id is None:
+        return db.execute(_pick(ITEM_VERSIONS_PAGE, after_id), params).all()
+    params["owner_id"] = owner_id
+    return db.execute(_pick(OWNER_ITEM_VERSIONS_PAGE, after_id), params).all()
 
 
-def get_items(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Item).offset(skip).limit(limit).all()
+def user_exists(db: Session, user_id: int) -> bool:
+    return db.scalar(USER_EXISTS, {"user_id": user_id}) is not None
+
+
+def get_items(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None, owner_id: int | None = None):
+    params = _page_params(skip, limit, after_id)
+    if owner_id is None:
+        return db.scalars(_pick(ITEMS_PAGE, after_id), params).all()
+    # (owner_id, id) -indeksi hoitaa sekä suodatuksen että järjestyksen
+    params["owner_id"] = owner_id
+    return db.scalars(_pick(OWNER_ITEMS_PAGE, after_id), params).all()
 
 
 def create_item(db: Session, item: schemas.ItemRequest, user_id: int):
@@ -36,6 +293,121 @@ def create_item(db: Session, item: schemas.ItemRequest, user_id: int):
     db.add(db_item)
     db.commit()
     db.refresh(db_item)
+    invalidate_user(user_id)
     return db_item
 
 
+def insert_items(db: Session, rows: list[dict]) -> list[int]:
+    # rows: ItemRequestin kentät + owner_id, voi olla eri omistajia (ks. batching.py)
+    if not rows:
+        return []
+    # ilman sort_by_parameter_orderia (joka SQLitellä tarkoittaisi rivi kerrallaan): saman transaktion
+    # multi-row insert saa kasvavat rowidit VALUES-järjestyksessä, joten järjestetyt id:t vastaa rivejä
+    statement = insert(models.Item).returning(models.Item.id)
+    ids = sorted(db.scalars(statement, rows).all())
+    db.commit()
+    for owner_id in {row["owner_id"] for row in rows}:
+        invalidate_user(owner_id)
+    return ids
+
+
+def create_items(db: Session, items: list[schemas.ItemRequest], user_id: int) -> list[schemas.BulkResult]:
+    ids = insert_items(db, [{**item.dict(), "owner_id": user_id} for item in items])
+    return [schemas.BulkResult(index=i, ok=True, id=item_id) for i, item_id in enumerate(ids)]
+
+
+"""
+Laskurit (models.Counter): triggerit pitää ne ajan tasalla insertin yhteydessä, joten lukeminen on yksi PK-haku
+COUNT(*):n sijaan. reconcile_counters laskee kaiken uudelleen ja korjaa mahdollisen heiton.
+"""
+
+
+USERS_COUNTER = "users"
+
+
+def items_counter(owner_id: int | None = None) -> str:
+    return "items" if owner_id is None else f"items:owner:{owner_id}"
+
+
+def get_count(db: Session, name: str) -> int:
+    return db.scalar(COUNTER_VALUE, {"name": name}) or 0
+
+
+"""
+Täsmäytys: laskenta ja kirjoitus on samassa lauseessa. Erillisinä pysqlite ajaisi COUNT(*)-SELECTit transaktion
+ulkopuolella (BEGIN lähtee vasta ennen ensimmäistä DML:ää), jolloin välissä commitoidut rivit jäisi laskematta
+ja täsmäytys kirjoittaisi triggerien oikeiden arvojen päälle vanhat. Nyt ensimmäinen lause ottaa
+kirjoituslukon heti, joten laskenta näkee kaiken mitä sitä ennen on commitoitu, eikä kukaan kirjoita välissä.
+"""
+RECONCILE_COUNTERS = text("""
+    INSERT INTO counters(name, value)
+    SELECT name, value FROM (
+        SELECT 'users' AS name, count(*) AS value FROM users
+        UNION ALL SELECT 'items', count(*) FROM items
+        UNION ALL SELECT 'items:owner:' || owner_id, count(*) FROM items GROUP BY owner_id
+    ) AS actual
+    WHERE true
+    ON CONFLICT(name) DO UPDATE SET value = excluded.value WHERE counters.value != excluded.value
+""")
+# WHERE true: ilman sitä SQLite tulkitsisi ON CONFLICTin SELECTin join-ehdoksi
+DELETE_STALE_COUNTERS = text("""
+    DELETE FROM counters
+    WHERE name LIKE 'items:owner:%' AND value != 0
+      AND NOT EXISTS (SELECT 1 FROM items WHERE items.owner_id = CAST(substr(counters.name, 13) AS INTEGER))
+""")
+
+
+def reconcile_counters(db: Session) -> int:
+    # palauttaa korjattujen laskureiden määrän (rowcount: lisätyt + muuttuneet + poistetut)
+    fixed = db.execute(RECONCILE_COUNTERS).rowcount + db.execute(DELETE_STALE_COUNTERS).rowcount
+    db.commit()
+    return fixed
+
+
+"""
+Tekstihaku items_fts:stä (ks. models.py). Käyttäjän syöte muutetaan FTS5:n fraaseiksi ("sana1" "sana2" = AND),
+ettei esim. - tai * tulkita hakusyntaksiksi. ORDER BY rank on FTS5:ssä oletuksena bm25, ja nopeampi kuin bm25() erikseen.
+"""
+
+SEARCH_ITEMS = text("""
+    SELECT items.id, items.title, items.description, items.owner_id
+    FROM items_fts JOIN items ON items.id = items_fts.rowid
+    WHERE items_fts MATCH :query
+    ORDER BY items_fts.rank
+    LIMIT :limit OFFSET :skip
+""")
+
+
+def fts_query(q: str) -> str:
+    return " ".join('"' + term.replace('"', '""') + '"' for term in q.split())
+
+
+def search_items(db: Session, q: str, skip: int = 0, limit: int = 20):
+    query = fts_query(q)
+    if not query:
+        return []
+    statement = select(models.Item).from_statement(SEARCH_ITEMS)
+    return db.scalars(statement, {"query": query, "limit": limit, "skip": skip}).all()
+
+
+"""
+Export-streamit: yield_per hakee rivit chunk kerrallaan palvelinpuolen cursorilla (stream_results),
+joten muistissa on kerrallaan vain yksi chunk riippumatta taulun koosta.
+"""
+
+
+def stream_users(db: Session, chunk: int = 1000):
+    query = (
+        select(models.User)
+        .options(selectinload(models.User.items))
+        .order_by(models.User.id)
+        .execution_options(yield_per=chunk, stream_results=True)
+    )
+    for db_user in db.scalars(query):
+        yield schemas.User.from_orm(db_user)
+
+
+def stream_items(db: Session, chunk: int = 1000):
+    query = select(models.Item).order_by(models.Item.id).execution_options(yield_per=chunk, stream_results=True)
+    for db_item in db.scalars(query):
+        yield schemas.Item.from_orm(db_item)
@@ -0,0 +1,103 @@
+import asyncio
+import contextvars
+import os
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+from . import crud, sharding
+from .database import SessionLocal, AsyncSessionLocal, read_session
+
+"""
+Sessiot ja poolin yhteydet: Session ottaa yhteyden poolista vasta ensimmäisessä kyselyssä, joten reitti joka
+palaa ennen kantaa (validointivirhe, cache-osuma, 304) ei vie yhteyttä ollenkaan. Yield-dependencyn finally
+ajetaan kuitenkin vasta kun vastaus on lähetetty, joten lukeva sessio pitää yhteyttä auki serialisoinnin ja
+lähetyksen ajan. Lisäksi sync-reitin response_model-validointi ja sync-generaattorin finally ajetaan molemmat
+threadpoolissa: kun kaikki threadpoolin säikeet odottaa yhteyttä poolista, yhteyksiä pitävät pyynnöt ei pääse
+etenemään ja kaikki jumittuu pool timeoutiin asti.
+
+ReleaseSessionsRoute sulkee pyynnön sessiot samassa säikeessä heti kun endpoint-funktio palaa, ennen
+serialisointia. Response_modelin kentät on silloin jo ladattu (selectin/joinedload), joten irrotetut
+ORM-objektit serialisoituu normaalisti. Dependencyn oma close on sen jälkeen no-op.
+DB_RELEASE_EARLY=0 palauttaa vanhan käytöksen (vertailu: python -m sql_app.bench pool).
+"""
+DB_RELEASE_EARLY = os.getenv("DB_RELEASE_EARLY", "1") == "1"
+
+_request_sessions: contextvars.ContextVar[list | None] = contextvars.ContextVar("request_sessions", default=None)
+
+
+def release_early(db):
+    # db: mikä tahansa jolla on close(), eli Session tai sharding.Shards. Contextvar kulkee threadpooliin mukana
+    sessions = _request_sessions.get()
+    if DB_RELEASE_EARLY and sessions is not None:
+        sessions.append(db)
+    return db
+
+
+def release_sessions():
+    sessions = _request_sessions.get()
+    while sessions:
+        sessions.pop().close()
+
+
+class ReleaseSessionsRoute(APIRoute):
+    def get_route_handler(self):
+        endpoint = self.dependant.call
+        if not asyncio.iscoroutinefunction(endpoint):
+            def call(**values):
+                try:
+                    return endpoint(**values)
+                finally:
+                    release_sessions()
+
+            self.dependant.call = call
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            token = _request_sessions.set([])
+            try:
+                return await handler(request)
+            finally:
+                release_sessions()  # jos endpointtiin asti ei päästy (esim. validointivirhe)
+                _request_sessions.reset(token)
+
+        return route_handler
+
+
+def get_after_id(cursor: str | None = None):
+    if cursor is None:
+        return None
+    try:
+        return crud.decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def get_db():
+    db = release_early(SessionLocal())
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_read_db(request: Request):
+    # GET-reiteille: replika, paitsi jos client on juuri kirjoittanut (ks. main.py:n middleware)
+    db = release_early(read_session(primary=getattr(request.state, "use_primary", False)))
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def get_shards():
+    shards = release_early(sharding.Shards())
+    try:
+        yield shards
+    finally:
+        shards.close()
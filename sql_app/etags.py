@@ -0,0 +1,34 @@
+import hashlib
+
+from fastapi import Response
+
+"""
+ETagit (main.py, async_routes.py ja sharded_routes.py): models.User/Item.version kasvaa joka kirjoituksella
+(triggerit, ks. models.py), ja userin versio myös sen itemien muuttuessa. Yksittäisen userin ETag on id + versio,
+listan ETag hash sivun (id, versio)-pareista ja X-Total-Countista, koska uusi rivi toisella sivulla muuttaa
+vastauksesta vain headerin. Cursor riippuu pelkästään sivun riveistä, joten se on jo mukana.
+If-None-Match tarkistetaan ennen varsinaista hakua kevyellä versiokyselyllä, joten 304 ei lataa eikä
+serialisoi itemeitä ollenkaan.
+"""
+
+
+def user_etag(user_id: int, version: int) -> str:
+    return f'"user-{user_id}-{version}"'
+
+
+def list_etag(kind: str, versions: list, total: int) -> str:
+    page = ";".join(f"{id}:{version}" for id, version in versions)
+    digest = hashlib.sha1(f"{total}|{page}".encode()).hexdigest()
+    return f'"{kind}-{digest[:20]}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # weak-vertailu (RFC 9110): W/-etuliite ei vaikuta, ja headerissa voi olla lista tai *
+    candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
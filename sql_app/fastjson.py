@@ -0,0 +1,30 @@
+import json
+import os
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # orjson on valinnainen, ilman sitä käytetään stdlibin jsonia samoilla asetuksilla
+    orjson = None
+
+"""
+Nopea vastauspolku listoille (FAST_JSON=1): dictit rakennetaan suoraan valituista sarakkeista (crud.*_rows),
+ja ne serialisoidaan kerralla ilman response_model-validointia ja jsonable_encoderia. Data tulee omasta
+kannasta, joten sitä ei tarvitse validoida uudelleen.
+
+Tulos on tavu tavulta sama kuin JSONResponsella: starlette käyttää json.dumpsia (ensure_ascii=False,
+separators=(",", ":")), ja orjson tuottaa saman kompaktin UTF-8:n.
+"""
+
+FAST_JSON = os.getenv("FAST_JSON", "0") == "1"
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(content, headers: dict | None = None) -> Response:
+    return Response(content=dumps(content), media_type="application/json", headers=headers)
@@ -1,10 +1,27 @@
-from fastapi import Depends, FastAPI, HTTPException
+import asyncio
+import logging
+import os
+
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
-from . import crud, models, schemas
-from .database import SessionLocal, engine
+from . import async_routes, batching, crud, fastjson, models, query_stats, schemas, sharded_routes, sharding
+from .database import DB_ASYNC, READ_YOUR_WRITES_SECONDS, SessionLocal, engine, pool_stats, read_session, replica_engines
+from .dependencies import ReleaseSessionsRoute, get_after_id, get_db, get_read_db
+from .etags import etag_matches, list_etag, not_modified, user_etag
+
+logger = logging.getLogger(__name__)
 
 models.Base.metadata.create_all(bind=engine)
+models.upgrade_indexes(engine)
+models.create_logins(engine)
+models.create_search_index(engine)
+models.create_counters(engine)
+models.create_versions(engine)
+if sharding.SHARDED:
+    sharding.create_shards()
 
 app = FastAPI()
 
@@ -14,47 +31,203 @@ https://fastapi.tiangolo.com/tutorial/sql-databases/#alembic-note
 https://fastapi.tiangolo.com/tutorial/sql-databases/#migrations
 
 huom ei awaittia niinkuin esimeissä oli muuten: https://fastapi.tiangolo.com/tutorial/sql-databases/#about-def-vs-async-def
+(async-versio reiteistä on async_routes.py:ssä, valitaan DB_ASYNC=1:llä)
 """
 
-# dependency
+router = APIRouter(route_class=ReleaseSessionsRoute)
+item_writer = batching.ItemWriteCoalescer(SessionLocal) if batching.ITEM_WRITE_BATCH else None
+
 
+def page_headers(rows: list, limit: int, total: int) -> dict:
+    # palautettu Response ei saa dependencyn response-headereita, joten ne kootaan erikseen molemmille poluille
+    headers = {"X-Total-Count": str(total)}
+    cursor = crud.next_cursor(rows, limit)
+    if cursor:
+        headers["X-Next-Cursor"] = cursor
+    return headers
 
-def get_db():
-    db = SessionLocal()
+
+def ndjson(stream, primary: bool = False):
+    # oma sessio generaattorille: StreamingResponse lukee sitä vielä kun reitti on jo palannut
+    db = read_session(primary=primary)
     try:
-        yield db
+        for row in stream(db):
+            yield row.json() + "\n"
     finally:
         db.close()
 
 
-@app.post("/users/", response_model=schemas.User)
+@router.post("/users/", response_model=schemas.User)
 def create_user(user: schemas.UserRequest, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
+    db_user = crud.create_user(db=db, user=user)
+    if db_user is None:
         raise HTTPException(status_code=400, detail="Email already in use")
-    return crud.create_user(db=db, user=user)
+    return db_user
 
 
-@app.get("/users/", response_model=list[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
+@router.post("/users/bulk", response_model=list[schemas.BulkResult])
+def create_users(users: list[schemas.UserRequest], db: Session = Depends(get_db)):
+    return crud.create_users(db=db, users=users)
+
+
+@router.get("/users/", response_model=list[schemas.User])
+def read_users(response: Response, skip: int = 0, limit: int = 100, after_id: int | None = Depends(get_after_id), if_none_match: str | None = Header(default=None), db: Session = Depends(get_read_db)):
+    # skip/limit toimii vanhoille clienteille, ?cursor=<X-Next-Cursor> jatkaa keysetillä
+    total = crud.get_count(db, crud.USERS_COUNTER)
+    etag = list_etag("users", crud.get_user_versions(db, skip=skip, limit=limit, after_id=after_id), total)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    if fastjson.FAST_JSON:
+        users = crud.get_users_rows(db, skip=skip, limit=limit, after_id=after_id)
+        return fastjson.json_response(users, headers={**page_headers(users, limit, total), "ETag": etag})
+    users = crud.get_users(db, skip=skip, limit=limit, after_id=after_id)
+    response.headers.update(page_headers(users, limit, total))
+    response.headers["ETag"] = etag
     return users
 
 
-@app.get("/users/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
-    if db_user is None:
+# ennen /users/{user_id}:tä, muuten "export" yritetään parsia id:ksi
+@router.get("/users/export")
+def export_users(request: Request):
+    stream = ndjson(crud.stream_users, primary=getattr(request.state, "use_primary", False))
+    return StreamingResponse(stream, media_type="application/x-ndjson")
+
+
+@router.get("/users/{user_id}", response_model=schemas.User)
+def read_user(user_id: int, request: Request, response: Response, if_none_match: str | None = Header(default=None), db: Session = Depends(get_read_db)):
+    # primarylle pinnattu client ei saa lukea replikalta täytettyä cachea (read-your-writes)
+    fresh = getattr(request.state, "use_primary", False)
+    if if_none_match:
+        version = crud.get_user_version(db, user_id=user_id, fresh=fresh)
+        if version is not None and etag_matches(if_none_match, user_etag(user_id, version)):
+            return not_modified(user_etag(user_id, version))
+    entry = crud.get_user_with_version(db, user_id=user_id, fresh=fresh)
+    if entry is None:
         raise HTTPException(status_code=404, detail="User not found")
+    db_user, version = entry
+    response.headers["ETag"] = user_etag(user_id, version)
     return db_user
 
 
-@app.post("/users/{user_id}/items", response_model=schemas.Item)
+@router.post("/users/{user_id}/items", response_model=schemas.Item)
 def create_item(user_id: int, item: schemas.ItemRequest, db: Session = Depends(get_db)):
+    if item_writer:
+        try:
+            return item_writer.submit(item, user_id)
+        except TimeoutError:
+            raise HTTPException(status_code=503, detail="Item write timed out", headers={"Retry-After": "1"})
     return crud.create_item(db=db, item=item, user_id=user_id)
 
 
-@app.get("/items/", response_model=list[schemas.Item])
-def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    items = crud.get_items(db, skip=skip, limit=limit)
+@router.post("/users/{user_id}/items/bulk", response_model=list[schemas.BulkResult])
+def create_items(user_id: int, items: list[schemas.ItemRequest], db: Session = Depends(get_db)):
+    if not crud.user_exists(db, user_id=user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    return crud.create_items(db=db, items=items, user_id=user_id)
+
+
+@router.get("/items/", response_model=list[schemas.Item])
+def read_items(response: Response, skip: int = 0, limit: int = 100, owner_id: int | None = None, after_id: int | None = Depends(get_after_id), if_none_match: str | None = Header(default=None), db: Session = Depends(get_read_db)):
+    total = crud.get_count(db, crud.items_counter(owner_id))
+    etag = list_etag("items", crud.get_item_versions(db, skip=skip, limit=limit, after_id=after_id, owner_id=owner_id), total)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    if fastjson.FAST_JSON:
+        items = crud.get_items_rows(db, skip=skip, limit=limit, after_id=after_id, owner_id=owner_id)
+        return fastjson.json_response(items, headers={**page_headers(items, limit, total), "ETag": etag})
+    items = crud.get_items(db, skip=skip, limit=limit, after_id=after_id, owner_id=owner_id)
+    response.headers.update(page_headers(items, limit, total))
+    response.headers["ETag"] = etag
     return items
+
+
+@router.get("/items/search", response_model=list[schemas.Item])
+def search_items(q: str = Query(min_length=1), skip: int = 0, limit: int = Query(default=20, le=100), db: Session = Depends(get_read_db)):
+    return crud.search_items(db, q=q, skip=skip, limit=limit)
+
+
+@router.get("/items/export")
+def export_items(request: Request):
+    stream = ndjson(crud.stream_items, primary=getattr(request.state, "use_primary", False))
+    return StreamingResponse(stream, media_type="application/x-ndjson")
+
+
+if sharding.SHARDED:
+    app.include_router(sharded_routes.router)
+else:
+    app.include_router(async_routes.router if DB_ASYNC else router)
+
+
+if replica_engines:
+    @app.middleware("http")
+    async def pin_writers_to_primary(request: Request, call_next):
+        request.state.use_primary = request.method != "GET" or "db_primary" in request.cookies
+        response = await call_next(request)
+        if READ_YOUR_WRITES_SECONDS and request.method != "GET" and response.status_code < 400:
+            response.set_cookie("db_primary", "1", max_age=READ_YOUR_WRITES_SECONDS, httponly=True)
+        return response
+
+
+@app.middleware("http")
+async def add_db_stats_headers(request: Request, call_next):
+    stats, token = query_stats.start_request()
+    try:
+        response = await call_next(request)
+    finally:
+        query_stats.end_request(token)
+    # StreamingResponsen (export) kyselyt ajetaan vasta kun headerit on jo lähetetty, niitä tämä ei näe
+    response.headers.update(stats.headers())
+    query_stats.route_metrics.record(f"{request.method} {route_path(request)}", stats)
+    return response
+
+
+def route_path(request: Request) -> str:
+    # starlette laittaa scopeen vain endpointin, reitin polku (esim. /users/{user_id}) haetaan sen perusteella
+    endpoint = request.scope.get("endpoint")
+    for route in app.routes:
+        if getattr(route, "endpoint", None) is endpoint and endpoint is not None:
+            return route.path
+    return "<unmatched>"
+
+
+"""
+Laskureiden täsmäytys: ajetaan taustalla COUNTER_RECONCILE_SECONDS välein (0 = ei ollenkaan).
+"""
+COUNTER_RECONCILE_SECONDS = float(os.getenv("COUNTER_RECONCILE_SECONDS", "300"))
+
+
+def reconcile_counters():
+    with SessionLocal() as db:
+        fixed = crud.reconcile_counters(db)
+    if fixed:
+        logger.warning("reconcile_counters fixed %d drifted counters", fixed)
+
+
+async def reconcile_counters_periodically():
+    while True:
+        await asyncio.sleep(COUNTER_RECONCILE_SECONDS)
+        try:
+            await run_in_threadpool(reconcile_counters)
+        except Exception:
+            logger.exception("reconcile_counters failed")
+
+
+@app.on_event("startup")
+async def start_counter_reconciliation():
+    if COUNTER_RECONCILE_SECONDS > 0:
+        app.state.reconcile_task = asyncio.create_task(reconcile_counters_periodically())
+
+
+@app.get("/metrics/pool")
+def read_pool_metrics():
+    return pool_stats()
+
+
+@app.get("/metrics/routes")
+def read_route_metrics():
+    return query_stats.route_metrics.stats()
+
+
+@app.get("/metrics/cache")
+def read_cache_metrics():
+    return crud.user_cache.stats()
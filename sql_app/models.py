@@ -1,8 +1,16 @@
 """
 Eli database modelit. Schemassa pydantic-modelit joita käytetään koodissa.
+
+Indeksit on valittu crud.py:n kyselyjen mukaan (tarkistus: python -m sql_app.bench plans):
+ - id:t on INTEGER PRIMARY KEY eli SQLiten rowid, erillinen index=True niihin olisi turha kopio
+ - users.email: unique-indeksi, haku emaililla + tuplien esto
+ - users.username: unique-indeksi, main-security.py:n login ja tokenin user haetaan sillä (NULLit ei törmää)
+ - items (owner_id, id): userin itemit (selectin/joinedload) ja omistajan itemien sivutus id-järjestyksessä
+title/description-kenttiä ei suodateta, joten niissä ei ole indeksiä hidastamassa inserttejä.
+create_all ei koske olemassa oleviin tauluihin, joten vanhan kannan indeksit korjaa upgrade_indexes.
 """
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String, text
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -11,20 +19,181 @@ from .database import Base
 class User(Base):
     __tablename__ = "users"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
+    username = Column(String, unique=True, index=True, nullable=True)  # main-security.py:n login
+    full_name = Column(String, nullable=True)
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))  # ETag, ks. create_versions
 
-    items = relationship("Item", back_populates="owner")
+    items = relationship("Item", back_populates="owner", order_by="Item.id")
 
 
 class Item(Base):
     __tablename__ = "items"
 
-    id = Column(Integer, primary_key=True, index=True)
-    title = Column(String, index=True)
-    description = Column(String, index=True)
+    id = Column(Integer, primary_key=True)
+    title = Column(String)
+    description = Column(String)
     owner_id = Column(Integer, ForeignKey("users.id"))
+    version = Column(Integer, nullable=False, default=1, server_default=text("1"))
 
     owner = relationship("User", back_populates="items")
+
+    __table_args__ = (Index("ix_items_owner_id_id", "owner_id", "id"),)
+
+
+class Counter(Base):
+    # rivimäärät listojen X-Total-Count -headeriin, ettei tarvi COUNT(*):ia joka pyynnöllä (ks. create_counters)
+    __tablename__ = "counters"
+
+    name = Column(String, primary_key=True)  # "users", "items" tai "items:owner:<id>"
+    value = Column(Integer, nullable=False, default=0)
+
+
+# ennen uudelleensuunnittelua kaikissa sarakkeissa oli index=True
+OBSOLETE_INDEXES = ["ix_users_id", "ix_items_id", "ix_items_title", "ix_items_description"]
+
+
+def upgrade_indexes(engine):
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_items_owner_id_id ON items (owner_id, id)"))
+
+
+def add_missing_columns(conn, table: str, columns: dict[str, str]):
+    # columns: nimi -> ALTER TABLE ... ADD COLUMNin tyyppi ja oletus, vanhoja kantoja varten (create_all ei lisää sarakkeita)
+    existing = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+    for name, definition in columns.items():
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+
+
+def create_logins(engine):
+    # main-security.py:n login-sarakkeet vanhoihin kantoihin. SQLiten ADD COLUMN ei osaa UNIQUEa, joten indeksi erikseen
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        add_missing_columns(conn, "users", {"username": "VARCHAR", "full_name": "VARCHAR"})
+        conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)"))
+
+
+"""
+Tekstihaku itemeihin: SQLiten FTS5-virtuaalitaulu items_fts, "external content" eli teksti on vain items-taulussa
+ja items_fts:ssä pelkkä hakuindeksi. Triggerit pitää indeksin synkassa samassa transaktiossa kuin insertit
+(crud.create_item, bulk, batching), joten crud:n ei tarvitse tietää siitä mitään.
+create_all ei osaa virtuaalitauluja, joten nämä ajetaan erikseen (IF NOT EXISTS, eli käy myös vanhaan kantaan).
+"""
+
+ITEMS_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(title, description, content='items', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_ai AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_fts_ad AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    # rajattu tekstisarakkeisiin, ettei version kasvatus (ks. VERSION_DDL) kirjoita hakuindeksiä uudestaan.
+    # Vanhoissa kannoissa trigger oli ilman sarakelistaa, joten se luodaan uudelleen
+    "DROP TRIGGER IF EXISTS items_fts_au",
+    """CREATE TRIGGER items_fts_au AFTER UPDATE OF title, description ON items BEGIN
+        INSERT INTO items_fts(items_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO items_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+
+def create_search_index(engine):
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'items_fts'")).first()
+        for statement in ITEMS_FTS_DDL:
+            conn.execute(text(statement))
+        if not exists:
+            # vanhassa kannassa voi olla jo itemejä -> indeksoidaan ne kerralla
+            conn.execute(text("INSERT INTO items_fts(items_fts) VALUES ('rebuild')"))
+
+
+"""
+Laskurit pidetään ajan tasalla triggereillä: ne ajetaan samassa INSERTissä kuin itse rivi, joten
+crud.create_user pysyy yhtenä lauseena ja bulk- ja batching-polut päivittää laskurit ilman omaa koodia.
+Deletejä ei ole API:ssa, mutta triggerit hoitaa nekin. Jos laskuri silti heittää (esim. käsin ajettu SQL),
+crud.reconcile_counters korjaa sen, ks. main.py:n ajastettu ajo.
+"""
+
+COUNTER_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS users_count_ai AFTER INSERT ON users BEGIN
+        INSERT INTO counters(name, value) VALUES ('users', 1) ON CONFLICT(name) DO UPDATE SET value = value + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_count_ad AFTER DELETE ON users BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'users';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_count_ai AFTER INSERT ON items BEGIN
+        INSERT INTO counters(name, value) VALUES ('items', 1) ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        INSERT INTO counters(name, value) VALUES ('items:owner:' || new.owner_id, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_count_ad AFTER DELETE ON items BEGIN
+        UPDATE counters SET value = value - 1 WHERE name IN ('items', 'items:owner:' || old.owner_id);
+    END""",
+]
+
+
+def create_counters(engine):
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'users_count_ai'")).first()
+        for statement in COUNTER_DDL:
+            conn.execute(text(statement))
+    if not exists:
+        # vanhassa kannassa on jo rivejä -> lasketaan lähtöarvot kerran
+        from sqlalchemy.orm import Session
+
+        from .crud import reconcile_counters
+        with Session(engine) as db:
+            reconcile_counters(db)
+
+
+"""
+Versiot ETagia varten (ks. main.py): jokainen kirjoitus kasvattaa rivin versiota, ja userin versio kasvaa myös
+kun sen itemeihin tulee muutos, koska itemit on osa userin vastausta. Triggereillä samasta syystä kuin laskurit.
+WHEN new.version = old.version: jos päivitys asettaa version itse, triggeri ei koske siihen. Sama ehto estää
+rekursion: triggerin oma version kasvatus ei täytä WHENiä (items_version_au:lla version ei myöskään ole
+OF-listassa), ja SQLiten recursive_triggers on oletuksena pois.
+"""
+
+VERSION_DDL = [
+    # kaikki sarakkeet (myös username/full_name, joita main-security.py käyttää). Vanhoissa kannoissa trigger oli
+    # rajattu sarakelistaan, joten se luodaan uudelleen
+    "DROP TRIGGER IF EXISTS users_version_au",
+    """CREATE TRIGGER users_version_au AFTER UPDATE ON users
+    WHEN new.version = old.version BEGIN
+        UPDATE users SET version = old.version + 1 WHERE id = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_version_ai AFTER INSERT ON items BEGIN
+        UPDATE users SET version = version + 1 WHERE id = new.owner_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_version_ad AFTER DELETE ON items BEGIN
+        UPDATE users SET version = version + 1 WHERE id = old.owner_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS items_version_au AFTER UPDATE OF title, description, owner_id ON items
+    WHEN new.version = old.version BEGIN
+        UPDATE items SET version = old.version + 1 WHERE id = new.id;
+        UPDATE users SET version = version + 1 WHERE id IN (old.owner_id, new.owner_id);
+    END""",
+]
+
+
+def create_versions(engine):
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        for table in ("users", "items"):
+            add_missing_columns(conn, table, {"version": "INTEGER NOT NULL DEFAULT 1"})
+        for statement in VERSION_DDL:
+            conn.execute(text(statement))
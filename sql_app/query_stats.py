@@ -0,0 +1,113 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+"""
+Kyselyiden mittaus per pyyntö: enginen before/after_cursor_execute -eventit kirjaa jokaisen lauseen
+contextvarissa olevaan RequestStatsiin. main.py:n middleware luo sen pyynnön alussa, laittaa lopuksi
+X-DB-Queries / X-DB-Time / X-DB-Slowest -headerit ja kokoaa reittikohtaiset summat (/metrics/routes).
+Contextvar kulkee starletten threadpooliin mukana, joten sync-reitit näkyy samaan pyyntöön.
+Taustasäikeiden (batching, täsmäytys) kyselyt ei osu mihinkään pyyntöön, eikä niitä lasketa.
+
+Hitaat lauseet lokitetaan SQL:n ja parametrien kanssa, raja SLOW_QUERY_MS (0 = ei lokiteta).
+"""
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_PARAMS_MAX = 1000  # bulk-insertin parametrit voi olla valtava lista, lokiin vain alku
+
+slow_query_logger = logging.getLogger("sql_app.slow_query")
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slowest_sql: str | None = None
+
+    def record(self, statement: str, seconds: float):
+        self.queries += 1
+        self.total += seconds
+        if seconds > self.slowest:
+            self.slowest = seconds
+            self.slowest_sql = statement
+
+    def headers(self) -> dict:
+        return {
+            "X-DB-Queries": str(self.queries),
+            "X-DB-Time": f"{self.total * 1000:.3f}",
+            "X-DB-Slowest": f"{self.slowest * 1000:.3f}",
+        }
+
+
+_current: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar("request_stats", default=None)
+
+
+def start_request() -> tuple[RequestStats, contextvars.Token]:
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token: contextvars.Token):
+    _current.reset(token)
+
+
+class RouteMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes: dict[str, dict] = {}
+
+    def record(self, route: str, stats: RequestStats):
+        with self._lock:
+            m = self._routes.setdefault(route, {"requests": 0, "queries": 0, "db_time": 0.0, "db_time_max": 0.0, "slowest_sql": None, "slowest": 0.0})
+            m["requests"] += 1
+            m["queries"] += stats.queries
+            m["db_time"] += stats.total
+            m["db_time_max"] = max(m["db_time_max"], stats.total)
+            if stats.slowest > m["slowest"]:
+                m["slowest"] = stats.slowest
+                m["slowest_sql"] = stats.slowest_sql
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                route: {
+                    "requests": m["requests"],
+                    "queries_avg": m["queries"] / m["requests"],
+                    "db_time_avg_ms": m["db_time"] / m["requests"] * 1000,
+                    "db_time_max_ms": m["db_time_max"] * 1000,
+                    "slowest_ms": m["slowest"] * 1000,
+                    "slowest_sql": m["slowest_sql"],
+                }
+                for route, m in sorted(self._routes.items())
+            }
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+route_metrics = RouteMetrics()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context._query_start
+    stats = _current.get()
+    if stats is not None:
+        stats.record(statement, seconds)
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        slow_query_logger.warning(
+            "slow query %.1f ms: %s | params: %.*s", seconds * 1000, statement, SLOW_QUERY_PARAMS_MAX, repr(parameters)
+        )
+
+
+def instrument_queries(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
@@ -36,6 +36,14 @@ class User(UserBase):
     class Config:
         orm_mode = True
 
+
+class BulkResult(BaseModel):
+    # yksi per syöterivi, samassa järjestyksessä
+    index: int
+    ok: bool
+    id: int | None = None
+    error: str | None = None
+
 """
 orm_mode mahdollistaa datan lukemisen kuten dict:stä, ja user-items suhteen tjsp:
 https://fastapi.tiangolo.com/tutorial/sql-databases/#technical-details-about-orm-mode
@@ -0,0 +1,119 @@
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+
+from . import crud, schemas, sharding
+from .dependencies import ReleaseSessionsRoute, get_after_id, get_shards
+from .etags import etag_matches, list_etag, not_modified, user_etag
+
+"""
+Samat reitit kuin main.py:ssä, mutta shardattuna (ks. sharding.py). Käyttöön DB_SHARD_URLS:lla.
+"""
+
+router = APIRouter(route_class=ReleaseSessionsRoute)
+
+
+def page_headers(rows: list, limit: int, total: int) -> dict:
+    headers = {"X-Total-Count": str(total)}
+    cursor = crud.next_cursor(rows, limit)
+    if cursor:
+        headers["X-Next-Cursor"] = cursor
+    return headers
+
+
+def ndjson(stream):
+    # oma Shards generaattorille, kuten main.ndjson
+    shards = sharding.Shards()
+    try:
+        for row in stream(shards):
+            yield row.json() + "\n"
+    finally:
+        shards.close()
+
+
+@router.post("/users/", response_model=schemas.User)
+def create_user(user: schemas.UserRequest, shards: sharding.Shards = Depends(get_shards)):
+    db_user = sharding.create_user(shards, user=user)
+    if db_user is None:
+        raise HTTPException(status_code=400, detail="Email already in use")
+    return db_user
+
+
+@router.post("/users/bulk", response_model=list[schemas.BulkResult])
+def create_users(users: list[schemas.UserRequest], shards: sharding.Shards = Depends(get_shards)):
+    return sharding.create_users(shards, users=users)
+
+
+def check_skip(skip: int, after_id: int | None, owner_id: int | None = None):
+    # fan-out-listoilla jokainen shardi joutuu käymään läpi skip + limit riviä (ks. sharding.SHARD_MAX_SKIP)
+    if after_id is None and owner_id is None and skip > sharding.SHARD_MAX_SKIP:
+        raise HTTPException(status_code=400, detail=f"skip over {sharding.SHARD_MAX_SKIP} is not supported, use cursor")
+
+
+@router.get("/users/", response_model=list[schemas.User])
+def read_users(response: Response, skip: int = 0, limit: int = 100, after_id: int | None = Depends(get_after_id), if_none_match: str | None = Header(default=None), shards: sharding.Shards = Depends(get_shards)):
+    check_skip(skip, after_id)
+    total = sharding.get_count(shards, crud.USERS_COUNTER)
+    etag = list_etag("users", sharding.get_user_versions(shards, skip=skip, limit=limit, after_id=after_id), total)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    users = sharding.get_users(shards, skip=skip, limit=limit, after_id=after_id)
+    response.headers.update(page_headers(users, limit, total))
+    response.headers["ETag"] = etag
+    return users
+
+
+# ennen /users/{user_id}:tä, muuten "export" yritetään parsia id:ksi
+@router.get("/users/export")
+def export_users():
+    return StreamingResponse(ndjson(sharding.stream_users), media_type="application/x-ndjson")
+
+
+@router.get("/users/{user_id}", response_model=schemas.User)
+def read_user(user_id: int, response: Response, if_none_match: str | None = Header(default=None), shards: sharding.Shards = Depends(get_shards)):
+    if if_none_match:
+        version = sharding.get_user_version(shards, user_id=user_id)
+        if version is not None and etag_matches(if_none_match, user_etag(user_id, version)):
+            return not_modified(user_etag(user_id, version))
+    entry = sharding.get_user_with_version(shards, user_id=user_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    db_user, version = entry
+    response.headers["ETag"] = user_etag(user_id, version)
+    return db_user
+
+
+@router.post("/users/{user_id}/items", response_model=schemas.Item)
+def create_item(user_id: int, item: schemas.ItemRequest, shards: sharding.Shards = Depends(get_shards)):
+    return sharding.create_item(shards, item=item, user_id=user_id)
+
+
+@router.post("/users/{user_id}/items/bulk", response_model=list[schemas.BulkResult])
+def create_items(user_id: int, items: list[schemas.ItemRequest], shards: sharding.Shards = Depends(get_shards)):
+    if not sharding.user_exists(shards, user_id=user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    return sharding.create_items(shards, items=items, user_id=user_id)
+
+
+@router.get("/items/", response_model=list[schemas.Item])
+def read_items(response: Response, skip: int = 0, limit: int = 100, owner_id: int | None = None, after_id: int | None = Depends(get_after_id), if_none_match: str | None = Header(default=None), shards: sharding.Shards = Depends(get_shards)):
+    check_skip(skip, after_id, owner_id)
+    total = sharding.get_count(shards, crud.items_counter(owner_id), owner_id=owner_id)
+    versions = sharding.get_item_versions(shards, skip=skip, limit=limit, after_id=after_id, owner_id=owner_id)
+    etag = list_etag("items", versions, total)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    items = sharding.get_items(shards, skip=skip, limit=limit, after_id=after_id, owner_id=owner_id)
+    response.headers.update(page_headers(items, limit, total))
+    response.headers["ETag"] = etag
+    return items
+
+
+@router.get("/items/search", response_model=list[schemas.Item])
+def search_items(q: str = Query(min_length=1), skip: int = 0, limit: int = Query(default=20, le=100), shards: sharding.Shards = Depends(get_shards)):
+    check_skip(skip, None)
+    return sharding.search_items(shards, q=q, skip=skip, limit=limit)
+
+
+@router.get("/items/export")
+def export_items():
+    return StreamingResponse(ndjson(sharding.stream_items), media_type="application/x-ndjson")
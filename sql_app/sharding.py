@@ -0,0 +1,324 @@
+import heapq
+import itertools
+import os
+import threading
+from collections import defaultdict
+
+from sqlalchemy import Column, Integer, String, bindparam, create_engine, insert, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session, selectinload, sessionmaker
+
+from . import crud, models, schemas
+from .database import MeteredQueuePool, instrument, pool_args
+
+"""
+Shardaus: DB_SHARD_URLS="sqlite:///./shard0.db,sqlite:///./shard1.db,..." (pilkuilla, tyhjä = ei shardausta).
+User ja kaikki sen itemit on samalla shardilla, joka valitaan user_id:n hashista (shard_for), joten
+userin haku, itemin lisäys ja omistajan itemit osuu aina yhteen kantaan. Globaalit listat (/users/, /items/)
+kysytään jokaiselta shardilta samalla sivutuksella ja yhdistetään id-järjestyksessä heapq.mergellä.
+Offset-sivulla jokaisen shardin pitää palauttaa skip + limit riviä, joten yhdistetään pelkät id:t ja täydet
+rivit haetaan vain lopulliselle sivulle. Skip on silti rajattu (SHARD_MAX_SKIP), sen yli pitää käyttää cursoria.
+
+Hakemistokanta (DB_SHARD_DIRECTORY_URL) on pieni ja pysyy yhtenä:
+ - user_directory: email -> user_id, eli emailin uniikkius yli shardien ja reititys emaililla haettaessa
+ - id_blocks: id:t jaetaan hi/lo-blokkeina (SHARD_ID_BLOCK kpl kerrallaan), jotta id:t on globaalisti
+   uniikkeja ilman että jokainen insertti käy hakemistossa
+Reitit ovat sharded_routes.py:ssä. Bulk-lisäykset menee shardeittain, exportit yhdistetään id-järjestyksessä ja
+haku kysyy jokaiselta shardilta skip + limit osumaa ja yhdistää ne rankin mukaan.
+"""
+DB_SHARD_URLS = [url.strip() for url in os.getenv("DB_SHARD_URLS", "").split(",") if url.strip()]
+DB_SHARD_DIRECTORY_URL = os.getenv("DB_SHARD_DIRECTORY_URL", "sqlite:///./sql_app_directory.db")
+SHARD_ID_BLOCK = int(os.getenv("SHARD_ID_BLOCK", "1000"))
+SHARD_MAX_SKIP = int(os.getenv("SHARD_MAX_SKIP", "10000"))
+SHARDED = bool(DB_SHARD_URLS)
+
+DirectoryBase = declarative_base()
+
+
+class UserDirectory(DirectoryBase):
+    __tablename__ = "user_directory"
+
+    email = Column(String, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+
+
+class IdBlock(DirectoryBase):
+    __tablename__ = "id_blocks"
+
+    kind = Column(String, primary_key=True)  # "users" tai "items"
+    next_id = Column(Integer, nullable=False)
+
+
+def _engine(url: str):
+    engine = create_engine(url, connect_args={"check_same_thread": False}, poolclass=MeteredQueuePool, **pool_args)
+    instrument(engine)
+    return engine
+
+
+shard_engines = [_engine(url) for url in DB_SHARD_URLS]
+shard_sessions = [sessionmaker(autocommit=False, autoflush=False, bind=engine) for engine in shard_engines]
+directory_engine = _engine(DB_SHARD_DIRECTORY_URL) if SHARDED else None
+DirectorySession = sessionmaker(autocommit=False, autoflush=False, bind=directory_engine)
+
+
+def create_shards():
+    for engine in shard_engines:
+        models.Base.metadata.create_all(bind=engine)
+        models.upgrade_indexes(engine)
+        models.create_logins(engine)
+        models.create_search_index(engine)
+        models.create_counters(engine)
+        models.create_versions(engine)
+    DirectoryBase.metadata.create_all(bind=directory_engine)
+    with directory_engine.begin() as conn:
+        for kind in ("users", "items"):
+            conn.execute(text("INSERT OR IGNORE INTO id_blocks(kind, next_id) VALUES (:kind, 1)"), {"kind": kind})
+
+
+def shard_for(user_id: int) -> int:
+    # Knuthin multiplikatiivinen hash: peräkkäiset id:t (hi/lo-blokit) leviää tasaisesti shardeille
+    return (user_id * 2654435761) % 2**32 % len(shard_engines)
+
+
+class IdAllocator:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+
+    def _reserve(self):
+        statement = (
+            update(IdBlock)
+            .where(IdBlock.kind == self.kind)
+            .values(next_id=IdBlock.next_id + SHARD_ID_BLOCK)
+            .returning(IdBlock.next_id)
+        )
+        with DirectorySession() as db:
+            end = db.scalar(statement)
+            db.commit()
+        self._next, self._end = end - SHARD_ID_BLOCK, end
+
+    def next(self) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                self._reserve()
+            self._next += 1
+            return self._next - 1
+
+
+user_ids = IdAllocator("users")
+item_ids = IdAllocator("items")
+
+
+class Shards:
+    # sessio per shard avataan vasta kun sitä tarvitaan, eli yhden userin pyyntö koskee vain yhtä kantaa
+    def __init__(self):
+        self._sessions: dict[int, Session] = {}
+
+    def get(self, index: int) -> Session:
+        if index not in self._sessions:
+            self._sessions[index] = shard_sessions[index]()
+        return self._sessions[index]
+
+    def for_user(self, user_id: int) -> Session:
+        return self.get(shard_for(user_id))
+
+    def all(self) -> list[Session]:
+        return [self.get(index) for index in range(len(shard_sessions))]
+
+    def close(self):
+        for db in self._sessions.values():
+            db.close()
+        self._sessions.clear()
+
+
+def create_user(shards: Shards, user: schemas.UserRequest):
+    # email varataan ensin hakemistosta, se on ainoa paikka jossa uniikkius näkyy kaikkien shardien yli
+    user_id = user_ids.next()
+    with DirectorySession() as directory:
+        try:
+            directory.execute(insert(UserDirectory).values(email=user.email, user_id=user_id))
+            directory.commit()
+        except IntegrityError:
+            return None
+    db = shards.for_user(user_id)
+    try:
+        db.execute(insert(models.User).values(id=user_id, email=user.email, hashed_password=user.password + "not-really-a-hash", is_active=True))
+        db.commit()
+    except Exception:
+        db.rollback()
+        with DirectorySession() as directory:
+            directory.query(UserDirectory).filter(UserDirectory.email == user.email).delete()
+            directory.commit()
+        raise
+    return schemas.User(id=user_id, email=user.email, is_active=True, items=[])
+
+
+def create_users(shards: Shards, users: list[schemas.UserRequest]) -> list[schemas.BulkResult]:
+    # emailit varataan hakemistosta yhdellä INSERT OR IGNORElla: varaus on meidän, jos hakemistossa on meidän id
+    results = [None] * len(users)
+    rows, indexes, emails = [], [], set()
+    for i, user in enumerate(users):
+        if user.email in emails:
+            results[i] = schemas.BulkResult(index=i, ok=False, error="Email already in use")
+            continue
+        emails.add(user.email)
+        rows.append({"id": user_ids.next(), "email": user.email, "hashed_password": user.password + "not-really-a-hash", "is_active": True})
+        indexes.append(i)
+    reserved = {}
+    with DirectorySession() as directory:
+        directory.execute(insert(UserDirectory).prefix_with("OR IGNORE"), [{"email": row["email"], "user_id": row["id"]} for row in rows])
+        for start in range(0, len(rows), crud.IN_CHUNK):
+            emails = [row["email"] for row in rows[start:start + crud.IN_CHUNK]]
+            reserved.update(directory.execute(select(UserDirectory.email, UserDirectory.user_id).where(UserDirectory.email.in_(emails))).all())
+        directory.commit()
+    by_shard = defaultdict(list)
+    for i, row in zip(indexes, rows):
+        if reserved.get(row["email"]) != row["id"]:
+            results[i] = schemas.BulkResult(index=i, ok=False, error="Email already in use")
+        else:
+            by_shard[shard_for(row["id"])].append((i, row))
+    for index, shard_rows in by_shard.items():
+        db = shards.get(index)
+        try:
+            db.execute(insert(models.User), [row for _, row in shard_rows])
+            db.commit()
+        except Exception:
+            # kuten create_user: varaukset vapautetaan, muiden shardien jo commitoidut userit jää voimaan
+            db.rollback()
+            with DirectorySession() as directory:
+                directory.query(UserDirectory).filter(UserDirectory.email.in_([row["email"] for _, row in shard_rows])).delete()
+                directory.commit()
+            raise
+        for i, row in shard_rows:
+            results[i] = schemas.BulkResult(index=i, ok=True, id=row["id"])
+    return results
+
+
+def get_user(shards: Shards, user_id: int):
+    return crud.get_user(shards.for_user(user_id), user_id=user_id)
+
+
+def get_user_with_version(shards: Shards, user_id: int) -> tuple[schemas.User, int] | None:
+    return crud.get_user_with_version(shards.for_user(user_id), user_id=user_id)
+
+
+def get_user_version(shards: Shards, user_id: int) -> int | None:
+    return crud.get_user_version(shards.for_user(user_id), user_id=user_id)
+
+
+def get_user_by_email(shards: Shards, email: str):
+    with DirectorySession() as directory:
+        user_id = directory.scalar(select(UserDirectory.user_id).where(UserDirectory.email == email))
+    return None if user_id is None else get_user(shards, user_id)
+
+
+def user_exists(shards: Shards, user_id: int) -> bool:
+    return crud.user_exists(shards.for_user(user_id), user_id=user_id)
+
+
+def create_item(shards: Shards, item: schemas.ItemRequest, user_id: int):
+    db = shards.for_user(user_id)
+    db_item = models.Item(**item.dict(), id=item_ids.next(), owner_id=user_id)
+    db.add(db_item)
+    db.commit()
+    db.refresh(db_item)
+    crud.invalidate_user(user_id)
+    return db_item
+
+
+def create_items(shards: Shards, items: list[schemas.ItemRequest], user_id: int) -> list[schemas.BulkResult]:
+    # id:t allokaattorilta kasvavassa järjestyksessä, joten crud.insert_itemsin järjestetyt id:t vastaa rivejä
+    rows = [{**item.dict(), "id": item_ids.next(), "owner_id": user_id} for item in items]
+    ids = crud.insert_items(shards.for_user(user_id), rows)
+    return [schemas.BulkResult(index=i, ok=True, id=item_id) for i, item_id in enumerate(ids)]
+
+
+USER_IDS_PAGE = crud._page(select(models.User.id), models.User.id)
+ITEM_IDS_PAGE = crud._page(select(models.Item.id), models.Item.id)
+USERS_BY_IDS = select(models.User).options(selectinload(models.User.items)).where(models.User.id.in_(bindparam("ids", expanding=True)))
+ITEMS_BY_IDS = select(models.Item).where(models.Item.id.in_(bindparam("ids", expanding=True)))
+
+
+def _merge(pages: list[list], skip: int, limit: int, after_id: int | None) -> list:
+    # jokainen sivu on jo id-järjestyksessä; offset-sivutuksessa shardit hakee skip + limit id:tä ja skip tehdään vasta tässä
+    merged = heapq.merge(*pages)
+    start = 0 if after_id is not None else skip
+    return list(itertools.islice(merged, start, start + limit))
+
+
+def _shard_pages(shards: Shards, page: tuple, skip: int, limit: int, after_id: int | None) -> list[list]:
+    # sama sivu jokaiselta shardilta, shardien järjestyksessä
+    if after_id is None and skip > SHARD_MAX_SKIP:
+        raise ValueError(f"skip over {SHARD_MAX_SKIP} needs a cursor on sharded lists")
+    params = crud._page_params(0, limit if after_id is not None else skip + limit, after_id)
+    statement = crud._pick(page, after_id)
+    return [db.execute(statement, params).all() for db in shards.all()]
+
+
+def _fan_out(shards: Shards, ids_page: tuple, by_ids, skip: int, limit: int, after_id: int | None) -> list:
+    rows_by_shard = _shard_pages(shards, ids_page, skip, limit, after_id)
+    pages = [[(row.id, index) for row in rows] for index, rows in enumerate(rows_by_shard)]
+    ids_by_shard = defaultdict(list)
+    for row_id, index in _merge(pages, skip, limit, after_id):
+        ids_by_shard[index].append(row_id)
+    rows = [row for index, ids in ids_by_shard.items() for row in shards.get(index).scalars(by_ids, {"ids": ids})]
+    return sorted(rows, key=lambda row: row.id)
+
+
+def get_users(shards: Shards, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    return _fan_out(shards, USER_IDS_PAGE, USERS_BY_IDS, skip, limit, after_id)
+
+
+def get_items(shards: Shards, skip: int = 0, limit: int = 100, after_id: int | None = None, owner_id: int | None = None):
+    if owner_id is not None:
+        return crud.get_items(shards.for_user(owner_id), skip=skip, limit=limit, after_id=after_id, owner_id=owner_id)
+    return _fan_out(shards, ITEM_IDS_PAGE, ITEMS_BY_IDS, skip, limit, after_id)
+
+
+def get_user_versions(shards: Shards, skip: int = 0, limit: int = 100, after_id: int | None = None) -> list[tuple[int, int]]:
+    # (id, versio) samalle sivulle kuin get_users, listan ETagia varten
+    pages = [[tuple(row) for row in rows] for rows in _shard_pages(shards, crud.USER_VERSIONS_PAGE, skip, limit, after_id)]
+    return _merge(pages, skip, limit, after_id)
+
+
+def get_item_versions(shards: Shards, skip: int = 0, limit: int = 100, after_id: int | None = None, owner_id: int | None = None) -> list[tuple[int, int]]:
+    if owner_id is not None:
+        return crud.get_item_versions(shards.for_user(owner_id), skip=skip, limit=limit, after_id=after_id, owner_id=owner_id)
+    pages = [[tuple(row) for row in rows] for rows in _shard_pages(shards, crud.ITEM_VERSIONS_PAGE, skip, limit, after_id)]
+    return _merge(pages, skip, limit, after_id)
+
+
+def get_count(shards: Shards, name: str, owner_id: int | None = None) -> int:
+    if owner_id is not None:
+        return crud.get_count(shards.for_user(owner_id), name)
+    return sum(crud.get_count(db, name) for db in shards.all())
+
+
+def stream_users(shards: Shards):
+    # jokainen shardi streamaa id-järjestyksessä, heapq.merge pitää kerrallaan muistissa yhden rivin per shardi
+    return heapq.merge(*(crud.stream_users(db) for db in shards.all()), key=lambda user: user.id)
+
+
+def stream_items(shards: Shards):
+    return heapq.merge(*(crud.stream_items(db) for db in shards.all()), key=lambda item: item.id)
+
+
+SEARCH_ITEMS_RANKED = text("""
+    SELECT items.id, items.title, items.description, items.owner_id, items_fts.rank AS rank
+    FROM items_fts JOIN items ON items.id = items_fts.rowid
+    WHERE items_fts MATCH :query
+    ORDER BY items_fts.rank
+    LIMIT :limit OFFSET 0
+""")
+
+
+def search_items(shards: Shards, q: str, skip: int = 0, limit: int = 20) -> list[schemas.Item]:
+    # bm25 lasketaan shardin omista tilastoista, joten yhdistetty järjestys on likimääräinen
+    query = crud.fts_query(q)
+    if not query:
+        return []
+    pages = [db.execute(SEARCH_ITEMS_RANKED, {"query": query, "limit": skip + limit}).all() for db in shards.all()]
+    rows = itertools.islice(heapq.merge(*pages, key=lambda row: row.rank), skip, skip + limit)
+    return [schemas.Item(**{field: getattr(row, field) for field in crud.ITEM_FIELDS}) for row in rows]